@@ -1,13 +1,17 @@
 import pathlib
-import pydantic
-from typing import Type, Any, Callable, ParamSpec, Awaitable, TypeVar, AsyncIterable
-import yaml
+from typing import Type, Any, Callable, ParamSpec, Awaitable, TypeVar, AsyncIterable, AsyncGenerator, Protocol, Self
 from functools import wraps, lru_cache
 import abc
-import io
 import asyncio
 import functools
 import diskcache
+import hashlib
+import time
+import os
+import re
+import tempfile
+import threading
+from contextlib import asynccontextmanager
 
 
 
@@ -21,11 +25,100 @@ CACHE_PATH = pathlib.Path('../data/cache').resolve()
 
 CACHES = {
     'pdf_page_svg': diskcache.Cache(CACHE_PATH / 'pdf_page_svg', size_limit=500_000_000),
-    'parsed_document': diskcache.Cache(CACHE_PATH / 'parsed_document', size_limit=500_000_000),
+    'parsed_document': diskcache.Cache(CACHE_PATH / 'parsed_document', eviction_policy='none'), # evicted by ContentAddressedCache
     'paperless_data': diskcache.Cache(CACHE_PATH / 'paperless_data', size_limit=50_000_000)
 }
 
 
+class CacheFormatError(Exception):
+    pass
+
+
+class ContentAddressedCache:
+    """Stores values under the digest of their content, with aliases (the cache keys) pointing to them.
+
+    A value stored under several keys is stored only once. When the cache exceeds its size limit, the least
+    recently used aliases are evicted, and values are removed once no alias points to them anymore.
+    """
+
+    ACCESS_TIME_RESOLUTION = 60 # seconds, limits writes for updating alias access times
+
+    def __init__(self, cache: diskcache.Cache, size_limit: int):
+        self.cache = cache
+        self.size_limit = size_limit
+
+    @staticmethod
+    def get_digest(value: bytes) -> str:
+        return hashlib.blake2b(value, digest_size=20).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        alias: tuple[str, float] | None = self.cache.get(f'alias:{key}')
+        if alias is None:
+            return None
+
+        digest, last_used = alias
+        value: bytes | None = self.cache.get(f'value:{digest}')
+        if value is not None and time.time() - last_used > self.ACCESS_TIME_RESOLUTION:
+            with self.cache.transact():
+                # Unless the alias has been changed or evicted since it was read
+                current: tuple[str, float] | None = self.cache.get(f'alias:{key}')
+                if current is not None and current[0] == digest:
+                    self.cache.set(f'alias:{key}', (digest, time.time()))
+        return value
+
+    def set(self, key: str, value: bytes):
+        digest = self.get_digest(value)
+        with self.cache.transact():
+            previous: tuple[str, float] | None = self.cache.get(f'alias:{key}')
+            self.cache.set(f'alias:{key}', (digest, time.time()))
+            if previous is not None and previous[0] == digest:
+                return
+
+            if f'value:{digest}' not in self.cache:
+                self.cache.set(f'value:{digest}', value)
+            self.cache.incr(f'refs:{digest}')
+            if previous is not None:
+                self._release(previous[0])
+
+        if self.cache.volume() > self.size_limit:
+            self.cull()
+
+    def _release(self, digest: str):
+        if self.cache.decr(f'refs:{digest}') <= 0:
+            self.cache.delete(f'refs:{digest}')
+            self.cache.delete(f'value:{digest}')
+
+    def cull(self):
+        # Evicts least recently used aliases until the cache is at 90% of its size limit
+        aliases: list[tuple[float, str]] = []
+        for key in list(self.cache.iterkeys()):
+            if not isinstance(key, str) or not key.startswith(('alias:', 'value:', 'refs:')):
+                self.cache.delete(key) # entry from before the cache was content-addressed
+            elif key.startswith('alias:') and (alias := self.cache.get(key)) is not None:
+                aliases.append((alias[1], key))
+
+        aliases.sort()
+        target_size = self.size_limit * 0.9
+        for _last_used, key in aliases:
+            if self.cache.volume() <= target_size:
+                break
+            with self.cache.transact():
+                alias = self.cache.pop(key)
+                if alias is not None:
+                    self._release(alias[0])
+
+    async def get_async(self, key: str) -> bytes | None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, key)
+
+    async def set_async(self, key: str, value: bytes):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.set, key, value)
+
+
+PARSED_DOCUMENT_CACHE = ContentAddressedCache(CACHES['parsed_document'], size_limit=500_000_000)
+
+
 async def cache_get_async(cache: diskcache.Cache, key: str, read: bool = False) -> Any:
     loop = asyncio.get_running_loop()
     future = loop.run_in_executor(None, functools.partial(cache.get, key, read=read))
@@ -65,87 +158,101 @@ class AsyncCache[T](abc.ABC):
         return async_cache_wrapper
 
 
-class AsyncBytesCache[T](abc.ABC):
-    def __init__(self, cache_id: str, cache_key_func: CacheKeyFunc | None = None, expire: float | None = None):
-        self.cache = CACHES[cache_id]
-        self.cache_key_func = cache_key_func or base_cache_key_func
-        self.expire = expire
-
-    def __call__(self, f: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
-        @wraps(f)
-        async def async_bytes_cache_wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-            key = await self.cache_key_func(*args, **kwargs)
-            data = await cache_get_async(self.cache, key)
-            if data is not None:
-                return await self.load_from_cache(data)
-            else:
-                value = await f(*args, **kwargs)
-                data = await self.dump_to_cache(value)
-                await cache_set_async(self.cache, key, data, self.expire)
-                return value
-
-        return async_bytes_cache_wrapper
-
-    @abc.abstractmethod
-    async def load_from_cache(self, data: bytes) -> T:
-        raise NotImplementedError
-    
-    @abc.abstractmethod
-    async def dump_to_cache(self, value: T) -> bytes:
-        raise NotImplementedError
-
-
-PT = TypeVar('PT', bound=pydantic.BaseModel)
+class BlobStore:
+    """Files stored on disk by key (eg. a checksum of their contents), so that they can be read from their path.
+
+    The least recently used files are removed when the store exceeds its size limit, except for files that are
+    in use (see acquire() and release()). Concurrent requests for a missing file share one fetch.
+    """
+
+    def __init__(self, path: pathlib.Path, size_limit: int):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size_limit = size_limit
+        self.in_use: dict[str, int] = {}
+        self.fetches: dict[str, asyncio.Task[None]] = {}
+        self.lock = threading.Lock() # cull() runs in an executor thread
+
+    def get_path(self, key: str) -> pathlib.Path:
+        assert re.fullmatch(r'[\w.+-]+', key), f'Invalid blob key {key!r}'
+        return self.path / key
+
+    async def acquire(self, key: str, fetch: Callable[[], AsyncIterable[bytes]]) -> pathlib.Path:
+        # Returns the path of the file, fetching it first if it is not stored. It is not removed until released.
+        path = self.get_path(key)
+        with self.lock:
+            # Marked as in use before checking for the file, so that it can't be removed by cull() once found
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+            try:
+                os.utime(path) # the modification time is used as last access time
+                exists = True
+            except FileNotFoundError:
+                exists = False
+        try:
+            if not exists:
+                task = self.fetches.get(key)
+                if task is None:
+                    task = self.fetches[key] = asyncio.create_task(self._fetch(path, fetch))
+                    task.add_done_callback(lambda _t: self.fetches.pop(key, None))
+                await asyncio.shield(task)
+        except BaseException:
+            self.release(key)
+            raise
+        return path
+
+    def release(self, key: str):
+        with self.lock:
+            self.in_use[key] -= 1
+            if self.in_use[key] == 0:
+                del self.in_use[key]
+
+    @asynccontextmanager
+    async def open(self, key: str, fetch: Callable[[], AsyncIterable[bytes]]) -> AsyncGenerator[pathlib.Path, None]:
+        path = await self.acquire(key, fetch)
+        try:
+            yield path
+        finally:
+            self.release(key)
+
+    async def _fetch(self, path: pathlib.Path, fetch: Callable[[], AsyncIterable[bytes]]):
+        loop = asyncio.get_running_loop()
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in fetch():
+                    await loop.run_in_executor(None, f.write, chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        await loop.run_in_executor(None, self.cull)
+
+    def cull(self):
+        entries = [(e.stat().st_mtime, e.stat().st_size, e.name) for e in os.scandir(self.path) if e.is_file() and not e.name.startswith('.tmp-')]
+        size = sum(e[1] for e in entries)
+        for _mtime, file_size, name in sorted(entries):
+            if size <= self.size_limit:
+                break
+            with self.lock:
+                if name in self.in_use:
+                    continue
+                (self.path / name).unlink(missing_ok=True)
+            size -= file_size
+
+
+class BinarySerializable(Protocol):
+    def to_bytes(self) -> bytes: ...
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Self: ...
+
+
+BT = TypeVar('BT', bound=BinarySerializable)
 
 
 @lru_cache(maxsize=1024)
-def parse_yaml_and_validate_model(Model: Type[PT], s: bytes) -> PT:
-    return Model.model_validate(yaml.load(s.decode('utf-8'), Loader=yaml.CLoader))
-
-
-class pydantic_yaml_cache(AsyncBytesCache[PT]):
-    def __init__(self, Model: Type[PT], cache_name: str, cache_key_func: CacheKeyFunc | None = None, expire: float | None = None):
-        super().__init__(cache_name, cache_key_func=cache_key_func)
-        self.Model = Model
-
-    async def load_from_cache(self, data: bytes) -> PT:
-        return parse_yaml_and_validate_model(self.Model, data)
-
-    async def dump_to_cache(self, value: PT) -> bytes:
-        s = yaml.dump(value.model_dump(mode='json'), Dumper=yaml.CDumper)
-        return s.encode('utf-8')
-
-
-class AsyncIterableBytesCache:
-    def __init__(self, cache_id: str, cache_key_func: CacheKeyFunc | None = None, expire: float | None = None):
-        self.cache = CACHES[cache_id]
-        self.cache_key_func = cache_key_func or base_cache_key_func
-        self.expire = expire
-
-    def __call__(self, f: Callable[P, AsyncIterable[bytes]]) -> Callable[P, AsyncIterable[bytes]]:
-        @wraps(f)
-        async def async_iterable_bytes_cache_wrapper(*args: P.args, **kwargs: P.kwargs) -> AsyncIterable[bytes]:
-            key = await self.cache_key_func(*args, **kwargs)
-            reader = await cache_get_async(self.cache, key, read=True)
-            if reader is not None:
-                while True:
-                    chunk = reader.read(64000)
-                    if not chunk:
-                        break
-                    yield chunk
-            else:
-                data_bytes = io.BytesIO()
-                async for chunk in f(*args, **kwargs):
-                    # write to cache file buffer
-                    data_bytes.write(chunk)
-                    # also yield to caller
-                    yield chunk
-
-                await cache_set_async(self.cache, key, data_bytes.getvalue(), self.expire)
-        return async_iterable_bytes_cache_wrapper
-
-
-stream_cache = AsyncIterableBytesCache
+def parse_binary_model(Model: Type[BT], data: bytes) -> BT:
+    return Model.from_bytes(data)
 
 
 class AsyncIterableCache[T]:
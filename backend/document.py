@@ -4,13 +4,25 @@ from region import Pt, Region, RegionBase, RegionResult
 import paperless
 import asyncio
 import pdfplumber
+import pdfplumber.page
 import pdfminer.psparser
 import cache
 import logging
 import bisect
-import io
 import os
-from typing import AsyncIterable, AsyncIterator, Literal, cast, TYPE_CHECKING
+import struct
+import array
+import sys
+import functools
+import collections.abc
+import itertools
+import concurrent.futures
+import multiprocessing
+import numpy
+import numpy.typing
+from contextlib import asynccontextmanager
+from pydantic_core import core_schema
+from typing import Any, AsyncGenerator, AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, Literal, Sequence, cast, overload, TYPE_CHECKING
 
 
 if TYPE_CHECKING:
@@ -28,23 +40,137 @@ class TextRun(RegionBase):
         return hash((TextRun, self.text, hash(super())))
 
 
-def split_runs_into_lines(runs: list[TextRun]) -> list[list[TextRun]]:
+class TextRunView:
+    """Lightweight read-only text run, created when a run of a TextRuns sequence is accessed."""
+
+    __slots__ = ('x', 'y', 'x2', 'y2', 'text')
+
+    def __init__(self, x: float, y: float, x2: float, y2: float, text: str):
+        self.x = x
+        self.y = y
+        self.x2 = x2
+        self.y2 = y2
+        self.text = text
+
+    @property
+    def w(self) -> Pt:
+        return cast(Pt, self.x2 - self.x)
+
+    @property
+    def h(self) -> Pt:
+        return cast(Pt, self.y2 - self.y)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (TextRunView, TextRun)):
+            return NotImplemented
+        return (self.x, self.y, self.x2, self.y2, self.text) == (other.x, other.y, other.x2, other.y2, other.text)
+
+    def __hash__(self):
+        return hash((TextRunView, self.x, self.y, self.x2, self.y2, self.text))
+
+    def __repr__(self) -> str:
+        return f'TextRunView(x={self.x!r}, y={self.y!r}, x2={self.x2!r}, y2={self.y2!r}, text={self.text!r})'
+
+
+_TEXT_RUNS_JSON_SCHEMA = core_schema.list_schema(core_schema.typed_dict_schema({
+    name: core_schema.typed_dict_field(core_schema.str_schema() if name == 'text' else core_schema.float_schema())
+    for name in ('x', 'y', 'x2', 'y2', 'text')
+}))
+
+
+class TextRuns(collections.abc.Sequence[TextRunView]):
+    """Text runs of a page, stored as columns: coordinates in float arrays, texts in a single string with offsets.
+
+    Serializes to (and validates from) a list of TextRun.
+    """
+
+    __slots__ = ('xs', 'ys', 'x2s', 'y2s', 'text', 'text_offsets')
+
+    def __init__(self, xs: Iterable[float], ys: Iterable[float], x2s: Iterable[float], y2s: Iterable[float], texts: Iterable[str]):
+        self.xs = array.array('d', xs)
+        self.ys = array.array('d', ys)
+        self.x2s = array.array('d', x2s)
+        self.y2s = array.array('d', y2s)
+        texts = list(texts)
+        self.text = ''.join(texts)
+        self.text_offsets = array.array('I', [0, *itertools.accumulate(len(t) for t in texts)])
+        assert len(self.xs) == len(self.ys) == len(self.x2s) == len(self.y2s) == len(texts)
+
+    @classmethod
+    def from_runs(cls, runs: 'Iterable[TextRun | TextRunView]') -> 'TextRuns':
+        runs = list(runs)
+        return cls([r.x for r in runs], [r.y for r in runs], [r.x2 for r in runs], [r.y2 for r in runs], [r.text for r in runs])
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    @overload
+    def __getitem__(self, index: int) -> TextRunView: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[TextRunView]: ...
+
+    def __getitem__(self, index: int | slice) -> TextRunView | list[TextRunView]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return TextRunView(self.xs[index], self.ys[index], self.x2s[index], self.y2s[index], self.get_text(index))
+
+    def __iter__(self) -> Iterator[TextRunView]:
+        offsets = self.text_offsets
+        for i, (x, y, x2, y2) in enumerate(zip(self.xs, self.ys, self.x2s, self.y2s)):
+            yield TextRunView(x, y, x2, y2, self.text[offsets[i]:offsets[i + 1]])
+
+    def to_numpy(self) -> 'tuple[numpy.typing.NDArray[numpy.float64], ...]':
+        # Coordinate columns x, y, x2, y2 as numpy arrays sharing memory with the columns
+        return tuple(numpy.frombuffer(column, dtype=numpy.float64) for column in (self.xs, self.ys, self.x2s, self.y2s))
+
+    def get_text(self, index: int) -> str:
+        index = range(len(self))[index] # normalizes negative indexes, raises IndexError
+        return self.text[self.text_offsets[index]:self.text_offsets[index + 1]]
+
+    def texts(self) -> list[str]:
+        offsets = self.text_offsets
+        return [self.text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, TextRuns):
+            return NotImplemented
+        return self.xs == other.xs and self.ys == other.ys and self.x2s == other.x2s and self.y2s == other.y2s and \
+               self.text == other.text and self.text_offsets == other.text_offsets
+
+    def __repr__(self) -> str:
+        return f'TextRuns({list(self)!r})'
+
+    def to_json_list(self) -> list[dict[str, float | str]]:
+        return [{'x': x, 'y': y, 'x2': x2, 'y2': y2, 'text': text} for x, y, x2, y2, text in zip(self.xs, self.ys, self.x2s, self.y2s, self.texts())]
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: type, handler: pydantic.GetCoreSchemaHandler) -> core_schema.CoreSchema:
+        from_list = core_schema.no_info_after_validator_function(cls.from_runs, handler.generate_schema(list[TextRun]))
+        return core_schema.json_or_python_schema(
+            json_schema=from_list,
+            python_schema=core_schema.union_schema([core_schema.is_instance_schema(cls), from_list]),
+            serialization=core_schema.plain_serializer_function_ser_schema(cls.to_json_list, return_schema=_TEXT_RUNS_JSON_SCHEMA)
+        )
+
+
+def split_runs_into_lines(runs: list[TextRunView]) -> list[list[TextRunView]]:
     if not runs:
         return []
 
-    y_points: list[tuple[Pt, Literal['s', 'e'], TextRun]] = []
+    y_points: list[tuple[Pt, Literal['s', 'e'], TextRunView]] = []
     for run in runs:
         # Adjust top y-coord down by 25% of text height to reduce considered height of text for this step.
         # This reduces failures to detect y-gaps due to page skew, etc.
         adjusted_y = cast(Pt, run.y + run.h * 0.25)
         y_points.append((adjusted_y, 's', run))
-        y_points.append((run.y2, 'e', run))    
+        y_points.append((cast(Pt, run.y2), 'e', run))
 
     y_points = sorted(y_points, key=lambda yp: yp[0])
 
     depth = 0
-    lines: list[list[TextRun]] = []
-    current_line: list[TextRun] = [] # This list is maintained in sorted-by-x order
+    lines: list[list[TextRunView]] = []
+    current_line: list[TextRunView] = [] # This list is maintained in sorted-by-x order
     for _y, kind, run in y_points:
 
         if kind == 's':
@@ -65,53 +191,94 @@ def split_runs_into_lines(runs: list[TextRun]) -> list[list[TextRun]]:
     return lines
 
 
+class TextRunIndex:
+    """Spatial index of the text runs of a page, used to find the runs enclosed by a region.
+
+    Runs are bucketed into horizontal bands by the y-coordinate of their top edge. Within a band,
+    runs are sorted by x-coordinate, so a query only visits the bands overlapping the region and
+    the runs within the region's x-range of each band.
+    """
+
+    BAND_HEIGHT: float = 16.0
+
+    def __init__(self, runs: 'TextRuns'):
+        # band nr -> x-coords of runs ordered by x, and (index, y, x2, y2) of those runs in the same order
+        self.bands: dict[int, tuple[list[float], list[tuple[int, float, float, float]]]] = {}
+
+        bands: dict[int, list[tuple[float, int, float, float, float]]] = {}
+        for index, (x, y, x2, y2) in enumerate(zip(runs.xs, runs.ys, runs.x2s, runs.y2s)):
+            bands.setdefault(self.band_nr(y), []).append((x, index, y, x2, y2))
+        for band_nr, entries in bands.items():
+            entries.sort()
+            self.bands[band_nr] = ([e[0] for e in entries], [e[1:] for e in entries])
+
+    def band_nr(self, y: float) -> int:
+        return int(y // self.BAND_HEIGHT)
+
+    def find_enclosed(self, region: RegionBase) -> list[int]:
+        # Returns indexes (in ascending order) of runs with x > region.x, x2 <= region.x2,
+        # y > region.y and y2 <= region.y2
+        if not self.bands:
+            return []
+
+        rx2, ry, ry2 = region.x2, region.y, region.y2
+        result: list[int] = []
+        first_band = max(self.band_nr(ry), min(self.bands))
+        last_band = min(self.band_nr(ry2), max(self.bands))
+        for band_nr in range(first_band, last_band + 1):
+            band = self.bands.get(band_nr)
+            if band is None:
+                continue
+            xs, entries = band
+            start = bisect.bisect_right(xs, region.x)
+            end = bisect.bisect_right(xs, rx2, lo=start)
+            result.extend(index for index, y, x2, y2 in entries[start:end] if y > ry and x2 <= rx2 and y2 <= ry2)
+
+        result.sort()
+        return result
+
+
 class Page(pydantic.BaseModel):
     page_nr: int
     width: float
     height: float
-    text_runs: list[TextRun]
-    text_run_indexes_ordered_by_x: list[int]
-    text_run_indexes_ordered_by_y: list[int]
-    text_run_indexes_ordered_by_x2: list[int]
-    text_run_indexes_ordered_by_y2: list[int]
-
-    def get_region_text_lines(self, region: Region) -> list[list[str]]:
-        def x_key(index: int) -> Pt:
-            return self.text_runs[index].x
-        
-        def x2_key(index: int) -> Pt:
-            return self.text_runs[index].x2
-        
-        def y_key(index: int) -> Pt:
-            return self.text_runs[index].y
-
-        def y2_key(index: int) -> Pt:
-            return self.text_runs[index].y2
-
-        x_index =  bisect.bisect(self.text_run_indexes_ordered_by_x,  region.x,  key=x_key)
-        y_index =  bisect.bisect(self.text_run_indexes_ordered_by_y,  region.y,  key=y_key)
-        x2_index = bisect.bisect(self.text_run_indexes_ordered_by_x2, region.x2, key=x2_key)
-        y2_index = bisect.bisect(self.text_run_indexes_ordered_by_y2, region.y2, key=y2_key)
-        
-        result_indexes = set(self.text_run_indexes_ordered_by_x[x_index:]) & \
-                         set(self.text_run_indexes_ordered_by_x2[:x2_index]) & \
-                         set(self.text_run_indexes_ordered_by_y[y_index:]) & \
-                         set(self.text_run_indexes_ordered_by_y2[:y2_index])
-        
-        runs_in_region = [self.text_runs[i] for i in result_indexes]
-
-        text_lines = split_runs_into_lines(runs_in_region)
+    text_runs: TextRuns
+
+    _text_run_index: TextRunIndex | None = pydantic.PrivateAttr(None)
+
+    @property
+    def text_run_index(self) -> TextRunIndex:
+        # Built on first use, ie. once per parsed or loaded page
+        if self._text_run_index is None:
+            self._text_run_index = TextRunIndex(self.text_runs)
+        return self._text_run_index
+
+    def get_text_lines(self, run_indexes: Iterable[int]) -> list[list[str]]:
+        text_lines = split_runs_into_lines([self.text_runs[i] for i in run_indexes])
         return [[tr.text for tr in line] for line in text_lines]
 
-    def get_region_text(self, region: Region) -> str:
-        text_lines = self.get_region_text_lines(region)
-        lines = [' '.join(word) for word in text_lines]
-        text = '\n'.join(lines)
-        return text
+    def get_text(self, run_indexes: Iterable[int]) -> str:
+        return '\n'.join(' '.join(words) for words in self.get_text_lines(run_indexes))
+
+    def get_region_text_lines(self, region: RegionBase) -> list[list[str]]:
+        return self.get_text_lines(self.text_run_index.find_enclosed(region))
+
+    def get_region_text(self, region: RegionBase) -> str:
+        return self.get_text(self.text_run_index.find_enclosed(region))
 
     def evaluate_region(self, region: Region) -> RegionResult:
         return region.evaluate_on_page(self)
 
+    def evaluate_regions(self, regions: Iterable[Region]) -> list[RegionResult]:
+        # The runs enclosed by each region are found with a single comparison of all runs against all regions
+        regions = list(regions)
+        if not regions:
+            return []
+        xs, ys, x2s, y2s = self.text_runs.to_numpy()
+        bounds = numpy.array([(r.x, r.y, r.x2, r.y2) for r in regions], dtype=numpy.float64)
+        enclosed = (xs > bounds[:, 0:1]) & (ys > bounds[:, 1:2]) & (x2s <= bounds[:, 2:3]) & (y2s <= bounds[:, 3:4])
+        return [region.evaluate_on_text(self.page_nr, self.get_text(numpy.flatnonzero(mask).tolist())) for region, mask in zip(regions, enclosed)]
+
 
 class DocumentParseStatus(pydantic.BaseModel):
     datetime_parsed: pydantic.AwareDatetime
@@ -129,19 +296,159 @@ class DocumentBase(pydantic.BaseModel):
     parse_status: DocumentParseStatus
 
 
-class Document(DocumentBase):
-    pages: list[Page]
+class PageNotParsedError(Exception):
+    pass
+
+
+class LazyPages(collections.abc.Sequence[Page]):
+    """Page sequence whose pages are only loaded (eg. decoded from the cache) when accessed.
+
+    Pages of partially parsed documents that have not been parsed yet are listed in `unparsed`,
+    accessing them raises PageNotParsedError until they are added using set_parsed().
+    """
+
+    def __init__(self, num_pages: int, load_page: Callable[[int], Page] | None, unparsed: Iterable[int] = ()):
+        self._pages: list[Page | None] = [None] * num_pages
+        self._load_page = load_page
+        self.unparsed: set[int] = set(unparsed)
+        self.has_new_pages = False
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    @overload
+    def __getitem__(self, index: int) -> Page: ...
 
-    def evaluate_regions(self, regions: list[Region]) -> list[list[RegionResult]]: # 1 result per page
-        region_page_res: list[list[RegionResult]] = []
+    @overload
+    def __getitem__(self, index: slice) -> list[Page]: ...
 
-        for region in regions:
-            region_res: list[RegionResult] = []
+    def __getitem__(self, index: int | slice) -> Page | list[Page]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        index = range(len(self._pages))[index] # normalizes negative indexes, raises IndexError
+        page = self._pages[index]
+        if page is None:
+            if index in self.unparsed or self._load_page is None:
+                raise PageNotParsedError(f'Page {index} has not been parsed')
+            page = self._pages[index] = self._load_page(index)
+        return page
+
+    def set_parsed(self, pages: list[Page]):
+        for page in pages:
+            self._pages[page.page_nr] = page
+            self.unparsed.discard(page.page_nr)
+        self.has_new_pages = True
+
+    def truncate(self, num_pages: int):
+        del self._pages[num_pages:]
+        self.unparsed = set(i for i in self.unparsed if i < num_pages)
+        self.has_new_pages = True
+
+
+class Document(DocumentBase):
+    pages: Sequence[Page]
+    _parser: 'DocumentParser | None' = pydantic.PrivateAttr(None)
+
+    @pydantic.field_serializer('pages')
+    def serialize_pages(self, pages: Sequence[Page]) -> list[Page]:
+        return list(pages)
+
+    def to_bytes(self) -> bytes:
+        return pack_document(self)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Document':
+        return unpack_document(data)
+
+    def attach_parser(self, parser: 'DocumentParser'):
+        # Used by load_pages() to parse the pages that have not been parsed yet
+        self._parser = parser
+
+    def close_parser(self):
+        if self._parser is not None:
+            self._parser.close()
+            self._parser = None
+
+    @property
+    def is_fully_parsed(self) -> bool:
+        return not isinstance(self.pages, LazyPages) or not self.pages.unparsed
+
+    async def load_pages(self, page_nrs: Iterable[int]):
+        # Parses any of the given pages that have not been parsed yet
+        if not isinstance(self.pages, LazyPages):
+            return
+
+        missing = sorted(set(page_nrs) & self.pages.unparsed)
+        while missing:
+            assert self._parser is not None, 'Partially parsed document has no parser'
+            pages, error = await self._parser.parse_pages(missing)
+            self.pages.set_parsed(pages)
+            if error is None:
+                return
+
+            # Like a full parse, keep only the pages preceding the first page that fails. The pages before the failed
+            # one are parsed too, so that the document is truncated at the same page whichever pages were requested.
+            self.pages.truncate(min(set(missing) - set(p.page_nr for p in pages)))
+            self.parse_status = DocumentParseStatus(datetime_parsed=datetime.datetime.now().astimezone(), error=error)
+            missing = sorted(self.pages.unparsed)
+
+    async def load_all_pages(self):
+        await self.load_pages(range(len(self.pages)))
+
+    async def iter_pages(self, reverse: bool = False) -> AsyncIterator[Page]:
+        # Yields pages in order, parsing them in batches of PDF_PARSE_PAGES_PER_TASK pages as they are reached
+        page_nrs = list(reversed(range(len(self.pages))) if reverse else range(len(self.pages)))
+        for i, page_nr in enumerate(page_nrs):
+            if i % PDF_PARSE_PAGES_PER_TASK == 0:
+                await self.load_pages(page_nrs[i:i + PDF_PARSE_PAGES_PER_TASK])
+            if page_nr >= len(self.pages):
+                continue # document was truncated due to parsing error
+            yield self.pages[page_nr]
+
+    async def evaluate_regions(self, regions: list[Region], stop_early: bool = False) -> list[list[RegionResult]]: # 1 result per page
+        # Regions are evaluated page by page, so all regions evaluated on a page are matched against its text runs together.
+        # With stop_early, only the pages needed to determine the selected result of each region are evaluated (and parsed),
+        # the results of other pages are left empty.
+        region_page_res = [[RegionResult.no_match('')] * len(self.pages) for _region in regions]
+
+        def evaluate_on_page(page: Page, region_nrs: list[int]):
+            for region_nr, res in zip(region_nrs, page.evaluate_regions(regions[i] for i in region_nrs)):
+                region_page_res[region_nr][page.page_nr] = res
+
+        if not stop_early:
+            await self.load_all_pages()
             for page in self.pages:
-                res = page.evaluate_region(region)
-                region_res.append(res)
-            region_page_res.append(region_res)
-            
+                evaluate_on_page(page, list(range(len(regions))))
+        else:
+            # Negative page numbers count from the end of the document. If a parsing error truncates the document,
+            # these refer to other pages, so the pages are determined again until all of them could be loaded.
+            region_nrs_by_page: dict[int, list[int]] = {}
+            num_pages = -1
+            while num_pages != len(self.pages):
+                num_pages = len(self.pages)
+                region_nrs_by_page = {}
+                for region_nr, region in enumerate(regions):
+                    if isinstance(region.page, int) and -num_pages <= region.page < num_pages:
+                        region_nrs_by_page.setdefault(region.page % num_pages, []).append(region_nr)
+                await self.load_pages(region_nrs_by_page)
+
+            for page_nr, region_nrs in region_nrs_by_page.items():
+                evaluate_on_page(self.pages[page_nr], region_nrs)
+
+            for page_selection in ('first_match', 'last_match'):
+                pending = [region_nr for region_nr, region in enumerate(regions) if region.page == page_selection]
+                if not pending:
+                    continue
+                async for page in self.iter_pages(reverse=page_selection == 'last_match'):
+                    evaluate_on_page(page, pending)
+                    pending = [region_nr for region_nr in pending if region_page_res[region_nr][page.page_nr].group_values is None]
+                    if not pending:
+                        break
+
+        for region, region_res in zip(regions, region_page_res):
+            del region_res[len(self.pages):] # pages may have been truncated due to parsing error
+
             selected_result = region.get_selected_result(region_res)
             if selected_result:
                 selected_result.is_retained = True
@@ -149,151 +456,553 @@ class Document(DocumentBase):
         return region_page_res
 
 
-async def get_pdf_data(paperless_id: int, preprocess: 'PreprocessType') -> AsyncIterator[bytes]:
+# Binary cache format for parsed documents. Layout (all integers little-endian):
+#
+#   header:        magic, format version, flags, length of metadata
+#   metadata:      JSON of the DocumentBase fields
+#   string table:  number of strings, offsets (n + 1, u32), utf-8 data
+#   page table:    number of pages, offsets of page blocks (n + 1, u64, relative to end of page table)
+#   page blocks:   page_nr, width, height, number of runs, then columns x, y, x2, y2 (f64)
+#                  and text (u32 index into string table)
+#
+# An empty page block denotes a page that has not been parsed yet, the partially parsed flag is set if there are any.
+#
+# Cached data is trusted, so it is loaded with model_construct() instead of full validation.
+# Only the header and page table are read up front, the string table and the page blocks
+# are decoded when a page is first accessed.
+
+DOCUMENT_FORMAT_MAGIC = b'PLDD'
+DOCUMENT_FORMAT_VERSION = 3
+
+_HEADER = struct.Struct('<4sHHI')
+_FLAG_PARTIALLY_PARSED = 1
+_COUNT = struct.Struct('<I')
+_PAGE_HEADER = struct.Struct('<IddI')
+
+
+def _pack_array(typecode: str, values: 'list[float] | list[int] | array.array[float] | array.array[int]') -> bytes:
+    a = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+@overload
+def _unpack_array(typecode: Literal['d'], data: memoryview, offset: int, count: int) -> tuple['array.array[float]', int]: ...
+
+@overload
+def _unpack_array(typecode: Literal['I', 'Q'], data: memoryview, offset: int, count: int) -> tuple['array.array[int]', int]: ...
+
+def _unpack_array(typecode: Literal['d', 'I', 'Q'], data: memoryview, offset: int, count: int) -> tuple['array.array[float] | array.array[int]', int]:
+    a: array.array[float] | array.array[int] = array.array(typecode)
+    end = offset + a.itemsize * count
+    a.frombytes(data[offset:end])
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a, end
+
+
+def _pack_page(page: Page, strings: dict[str, int]) -> bytes:
+    runs = page.text_runs
+    text_ids = [strings.setdefault(text, len(strings)) for text in runs.texts()]
+    return b''.join([
+        _PAGE_HEADER.pack(page.page_nr, page.width, page.height, len(runs)),
+        _pack_array('d', runs.xs),
+        _pack_array('d', runs.ys),
+        _pack_array('d', runs.x2s),
+        _pack_array('d', runs.y2s),
+        _pack_array('I', text_ids),
+    ])
+
+
+def _unpack_page(data: memoryview, offset: int, strings: list[str]) -> Page:
+    page_nr, width, height, num_runs = _PAGE_HEADER.unpack_from(data, offset)
+    offset += _PAGE_HEADER.size
+    xs, offset = _unpack_array('d', data, offset, num_runs)
+    ys, offset = _unpack_array('d', data, offset, num_runs)
+    x2s, offset = _unpack_array('d', data, offset, num_runs)
+    y2s, offset = _unpack_array('d', data, offset, num_runs)
+    text_ids, offset = _unpack_array('I', data, offset, num_runs)
+
+    runs = TextRuns(xs, ys, x2s, y2s, [strings[t] for t in text_ids])
+    return Page.model_construct(page_nr=page_nr, width=width, height=height, text_runs=runs)
+
+
+def pack_document(doc: Document) -> bytes:
+    strings: dict[str, int] = {}
+    unparsed = doc.pages.unparsed if isinstance(doc.pages, LazyPages) else set[int]()
+    page_blocks = [b'' if page_nr in unparsed else _pack_page(doc.pages[page_nr], strings) for page_nr in range(len(doc.pages))]
+
+    page_offsets = [0]
+    for block in page_blocks:
+        page_offsets.append(page_offsets[-1] + len(block))
+
+    encoded_strings = [s.encode('utf-8') for s in strings]
+    string_offsets = [0]
+    for encoded in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+
+    metadata = doc.model_dump_json(exclude={'pages'}).encode('utf-8')
+
+    return b''.join([
+        _HEADER.pack(DOCUMENT_FORMAT_MAGIC, DOCUMENT_FORMAT_VERSION, _FLAG_PARTIALLY_PARSED if unparsed else 0, len(metadata)),
+        metadata,
+        _COUNT.pack(len(encoded_strings)),
+        _pack_array('I', string_offsets),
+        *encoded_strings,
+        _COUNT.pack(len(page_blocks)),
+        _pack_array('Q', page_offsets),
+        *page_blocks
+    ])
+
+
+def _unpack_header(data: bytes | memoryview) -> tuple[int, int]:
+    # Returns flags and length of metadata
+    if len(data) < _HEADER.size:
+        raise cache.CacheFormatError('Document data too short')
+
+    magic, version, flags, metadata_len = _HEADER.unpack_from(data, 0)
+    if magic != DOCUMENT_FORMAT_MAGIC:
+        raise cache.CacheFormatError('Not a binary document')
+    if version != DOCUMENT_FORMAT_VERSION:
+        raise cache.CacheFormatError(f'Unsupported document format version {version}')
+    return flags, metadata_len
+
+
+def is_partially_parsed_document(data: bytes) -> bool:
+    # Decided from the header only
+    flags, _metadata_len = _unpack_header(data)
+    return bool(flags & _FLAG_PARTIALLY_PARSED)
+
+
+def unpack_document(data: bytes) -> Document:
+    view = memoryview(data)
+    _flags, metadata_len = _unpack_header(view)
+
+    offset = _HEADER.size
+    base = DocumentBase.model_validate_json(bytes(view[offset:offset + metadata_len]))
+    offset += metadata_len
+
+    num_strings, = _COUNT.unpack_from(view, offset)
+    string_offsets, string_data_offset = _unpack_array('I', view, offset + _COUNT.size, num_strings + 1)
+    offset = string_data_offset + string_offsets[-1]
+
+    @functools.cache
+    def get_strings() -> list[str]:
+        string_data = bytes(view[string_data_offset:string_data_offset + string_offsets[-1]])
+        return [string_data[start:end].decode('utf-8') for start, end in zip(string_offsets, string_offsets[1:])]
+
+    num_pages, = _COUNT.unpack_from(view, offset)
+    page_offsets, offset = _unpack_array('Q', view, offset + _COUNT.size, num_pages + 1)
+
+    def load_page(page_index: int) -> Page:
+        return _unpack_page(view, offset + page_offsets[page_index], get_strings())
+
+    unparsed = [page_nr for page_nr in range(num_pages) if page_offsets[page_nr] == page_offsets[page_nr + 1]]
+    pages = LazyPages(num_pages, load_page, unparsed)
+
+    return Document.model_construct(pages=pages, **{name: getattr(base, name) for name in DocumentBase.model_fields})
+
+
+# Downloaded PDFs, keyed by checksum. PDFs are read from their files rather than being loaded into memory.
+PDF_STORE = cache.BlobStore(cache.CACHE_PATH / 'pdf', size_limit=int(os.environ.get('PDF_STORE_SIZE_LIMIT', '1000000000')))
+
+
+async def download_pdf(paperless_id: int) -> AsyncIterator[bytes]:
     c = paperless.PaperlessClient()
 
     async with c.get_document_stream(paperless_id) as stream:
-        if preprocess is None:
-            while True:
-                data, _ = await stream.readchunk()
-                if not data:
-                    break
-                yield data
-        elif preprocess == 'force-ocr':
-            log.info(f'Preprocessing document {paperless_id} using ocrmypdf')
-
-            ocrmypdf_langs = os.environ.get('OCR_LANGUAGES', 'eng')
-            proc = await asyncio.subprocess.create_subprocess_exec('ocrmypdf', '-l', ocrmypdf_langs, '-f', '--output-type', 'pdf', '-', '-', stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
-            assert proc.stdout is not None
-
-            async def feed_input():
-                assert proc.stdin is not None
-                while True:
-                    chunk, _ = await stream.readchunk()
-                    if not chunk:
-                        break
-                    proc.stdin.write(chunk)
-                    await proc.stdin.drain()
-                proc.stdin.close()
-                await proc.stdin.wait_closed()
+        while True:
+            data, _ = await stream.readchunk()
+            if not data:
+                break
+            yield data
 
-            # Start feeding in the background
-            feeder = asyncio.create_task(feed_input())
 
-            try:
-                while True:
-                    chunk = await proc.stdout.read(65536)
-                    if not chunk:
-                        break
-                    yield chunk
-            finally:
-                await feeder
-                await proc.wait()
+# OCR'd PDFs, keyed by checksum of the original and OCR languages
+OCR_STORE = cache.BlobStore(cache.CACHE_PATH / 'ocr', size_limit=int(os.environ.get('OCR_STORE_SIZE_LIMIT', '1000000000')))
+OCR_LANGUAGES: str = os.environ.get('OCR_LANGUAGES', 'eng')
+OCR_CONCURRENCY: int = max(1, int(os.environ.get('OCR_CONCURRENCY', '2')))
 
+_ocr_semaphore = asyncio.Semaphore(OCR_CONCURRENCY) # ocrmypdf runs tesseract processes for all CPUs itself
 
-async def async_iter_to_bytes(i: AsyncIterator[bytes]) -> io.BytesIO:
-    res = io.BytesIO()
-    async for chunk in i:
-        res.write(chunk)
-    return res
+
+async def ocr_pdf(paperless_id: int, checksum: str) -> AsyncIterator[bytes]:
+    # Queued behind at most OCR_CONCURRENCY running jobs, concurrent requests for the same document are deduplicated by OCR_STORE.
+    # The original PDF is acquired here rather than by the requester, as the job may outlive it (see BlobStore.acquire()).
+    async with PDF_STORE.open(checksum, functools.partial(download_pdf, paperless_id)) as input_path, _ocr_semaphore:
+        log.info(f'Preprocessing document {paperless_id} using ocrmypdf')
+
+        proc = await asyncio.subprocess.create_subprocess_exec('ocrmypdf', '-l', OCR_LANGUAGES, '-f', '--output-type', 'pdf', input_path, '-', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        assert proc.stdout is not None
+        try:
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if proc.returncode is None and not proc.stdout.at_eof():
+                proc.kill()
+            await proc.wait()
+
+        if proc.returncode != 0:
+            raise IOError(f'ocrmypdf failed for document {paperless_id} with exit code {proc.returncode}')
 
 
 X_TOLERANCE: Pt = Pt(6)
 Y_TOLERANCE: Pt = Pt(3)
 
 
-def get_pdf_pages(paperless_doc: paperless.PaperlessDocument, pdf_data: io.BytesIO) -> tuple[list[Page], str | None]:
-    pages: list[Page] = []
-    error: str | None = None
-
-    try:
-        with pdfplumber.open(pdf_data) as pdf:
-            for index, page in enumerate(pdf.pages):
-                runs: list[TextRun] = []
-                pdfplumber_text_runs = page.extract_words(keep_blank_chars=False, x_tolerance=int(X_TOLERANCE), y_tolerance=int(Y_TOLERANCE), use_text_flow=False)
-                for text_run in pdfplumber_text_runs:
-                    runs.append(TextRun(text=text_run['text'].strip(), x=text_run['x0'], y=text_run['top'], x2=text_run['x1'], y2=text_run['bottom']))
-                indexes_by_x = sorted(list(range(len(runs))), key=lambda i: runs[i].x)
-                indexes_by_y = sorted(list(range(len(runs))), key=lambda i: runs[i].y)
-                indexes_by_x2 = sorted(list(range(len(runs))), key=lambda i: runs[i].x2)
-                indexes_by_y2 = sorted(list(range(len(runs))), key=lambda i: runs[i].y2)
-                pages.append(Page(page_nr=index, text_runs=runs, width=page.width, height=page.height, text_run_indexes_ordered_by_x=indexes_by_x, text_run_indexes_ordered_by_y=indexes_by_y, text_run_indexes_ordered_by_x2=indexes_by_x2, text_run_indexes_ordered_by_y2=indexes_by_y2))
-            log.info('Parsed "%s" (%i)', paperless_doc.title, paperless_doc.id)
-    except pdfminer.psparser.PSException as e:
-        error = str(e)
-        log.error('Error parsing "%s" (%i): %s', paperless_doc.title, paperless_doc.id, error)
-
-    return pages, error
-
-
-async def get_parsed_document_cache_key_func(paperless_id: int, preprocess: 'PreprocessType', client: paperless.PaperlessClient | None = None) -> str:
+# PDF text extraction is CPU-bound pure Python, so by default it runs in a process pool to avoid
+# contending for the GIL with the API. Large PDFs are split into page ranges that are extracted in parallel.
+PDF_PARSE_BACKEND: Literal['process', 'thread'] = 'thread' if os.environ.get('PDF_PARSE_BACKEND', 'process').lower() == 'thread' else 'process'
+PDF_PARSE_WORKERS: int = int(os.environ.get('PDF_PARSE_WORKERS', '0')) or os.cpu_count() or 1
+PDF_PARSE_PAGES_PER_TASK: int = max(1, int(os.environ.get('PDF_PARSE_PAGES_PER_TASK', '8')))
+
+
+_pdf_parse_executor: concurrent.futures.Executor | None = None
+
+
+def get_pdf_parse_executor() -> concurrent.futures.Executor:
+    global _pdf_parse_executor
+    if _pdf_parse_executor is None:
+        if PDF_PARSE_BACKEND == 'process':
+            _pdf_parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=PDF_PARSE_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+        else:
+            _pdf_parse_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PDF_PARSE_WORKERS, thread_name_prefix='pdf_parse')
+        log.info(f'Started PDF parsing {PDF_PARSE_BACKEND} pool with {PDF_PARSE_WORKERS} workers')
+    return _pdf_parse_executor
+
+
+def shutdown_pdf_parse_executor():
+    global _pdf_parse_executor
+    if _pdf_parse_executor is not None:
+        _pdf_parse_executor.shutdown(cancel_futures=True)
+        _pdf_parse_executor = None
+
+
+def extract_page(page: pdfplumber.page.Page, page_nr: int) -> Page:
+    words = page.extract_words(keep_blank_chars=False, x_tolerance=int(X_TOLERANCE), y_tolerance=int(Y_TOLERANCE), use_text_flow=False)
+    runs = TextRuns([w['x0'] for w in words], [w['top'] for w in words], [w['x1'] for w in words], [w['bottom'] for w in words], [w['text'].strip() for w in words])
+    return Page(page_nr=page_nr, text_runs=runs, width=page.width, height=page.height)
+
+
+def get_pdf_page_count(pdf_path: str) -> int:
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def get_pdf_page_range(pdf_path: str, start: int, end: int) -> list[Page]:
+    # Runs in a pool worker, pages are returned to the caller by pickling
+    with pdfplumber.open(pdf_path, pages=list(range(start + 1, end + 1))) as pdf:
+        return [extract_page(page, page_nr) for page_nr, page in enumerate(pdf.pages, start)]
+
+
+class DocumentParser:
+    """Parses pages of a document on demand. The PDF is only downloaded (or taken from the PDF store) when it is first needed."""
+
+    def __init__(self, paperless_doc: paperless.PaperlessDocument, preprocess: 'PreprocessType'):
+        self.paperless_doc = paperless_doc
+        self.preprocess: 'PreprocessType' = preprocess
+        self._pdf_path: str | None = None
+        self._acquired: list[tuple[cache.BlobStore, str]] = []
+        self._lock = asyncio.Lock()
+
+    async def get_pdf_path(self) -> str:
+        async with self._lock:
+            if self._pdf_path is None:
+                checksum = await get_document_checksum(self.paperless_doc.id, modified=self.paperless_doc.modified)
+                if self.preprocess == 'force-ocr':
+                    store, key, fetch = OCR_STORE, f'{checksum}-{OCR_LANGUAGES}', functools.partial(ocr_pdf, self.paperless_doc.id, checksum)
+                else:
+                    store, key, fetch = PDF_STORE, checksum, functools.partial(download_pdf, self.paperless_doc.id)
+                self._pdf_path = str(await store.acquire(key, fetch))
+                self._acquired.append((store, key))
+            return self._pdf_path
+
+    def close(self):
+        # Allows the PDFs to be evicted from their stores
+        for store, key in self._acquired:
+            store.release(key)
+        self._acquired = []
+        self._pdf_path = None
+
+    async def get_page_count(self) -> int:
+        pdf_path = await self.get_pdf_path()
+        return await asyncio.get_running_loop().run_in_executor(get_pdf_parse_executor(), get_pdf_page_count, pdf_path)
+
+    async def parse_pages(self, page_nrs: list[int]) -> tuple[list[Page], str | None]:
+        # Consecutive pages are parsed together, in ranges of at most PDF_PARSE_PAGES_PER_TASK pages.
+        # On error, the pages parsed before the failing page are returned along with the error message.
+        pdf_path = await self.get_pdf_path()
+        loop = asyncio.get_running_loop()
+        executor = get_pdf_parse_executor()
+
+        page_ranges: list[tuple[int, int]] = []
+        for page_nr in sorted(page_nrs):
+            if page_ranges and page_ranges[-1][1] == page_nr and page_nr - page_ranges[-1][0] < PDF_PARSE_PAGES_PER_TASK:
+                page_ranges[-1] = (page_ranges[-1][0], page_nr + 1)
+            else:
+                page_ranges.append((page_nr, page_nr + 1))
+
+        futures = [loop.run_in_executor(executor, get_pdf_page_range, pdf_path, start, end) for start, end in page_ranges]
+        pages: list[Page] = []
+        error: str | None = None
+        try:
+            for (start, end), future in zip(page_ranges, futures):
+                try:
+                    pages.extend(await future)
+                except pdfminer.psparser.PSException:
+                    if end - start == 1:
+                        raise
+                    # Find the failing page, so that the pages preceding it in the range are kept
+                    for page_nr in range(start, end):
+                        pages.extend(await loop.run_in_executor(executor, get_pdf_page_range, pdf_path, page_nr, page_nr + 1))
+            log.info('Parsed pages %s of "%s" (%i)', ', '.join(f'{start + 1}-{end}' for start, end in page_ranges), self.paperless_doc.title, self.paperless_doc.id)
+        except pdfminer.psparser.PSException as e:
+            error = str(e)
+            log.error('Error parsing "%s" (%i): %s', self.paperless_doc.title, self.paperless_doc.id, error)
+        finally:
+            for future in futures:
+                future.cancel()
+
+        return pages, error
+
+
+# Part of the parsed document cache key, increment when changes to parsing affect the parsed pages
+PARSER_VERSION = 1
+
+
+async def get_document_checksum(paperless_id: int, client: paperless.PaperlessClient | None = None, modified: datetime.datetime | None = None) -> str:
+    # Usually answered from the document index without any request to paperless
     client = client or paperless.PaperlessClient()
-    return await cache.base_cache_key_func(paperless_id, preprocess) + '-' + str(await client.get_document_modified_date(paperless_id))
+    return await paperless.DOCUMENT_INDEX.get_checksum(client, paperless_id, modified)
 
 
-@cache.pydantic_yaml_cache(Document, 'parsed_document', cache_key_func=get_parsed_document_cache_key_func)
-async def get_parsed_document(paperless_id: int, preprocess: 'PreprocessType', *, client: paperless.PaperlessClient | None = None) -> Document:
-    client = client or paperless.PaperlessClient()
+async def get_parsed_document_cache_key(paperless_id: int, preprocess: 'PreprocessType', checksum: str) -> str:
+    # Keyed on the file contents rather than the modification date, so metadata changes (including
+    # the ones made by processing) don't invalidate the parsed document
+    key_args = (paperless_id, preprocess, OCR_LANGUAGES) if preprocess == 'force-ocr' else (paperless_id, preprocess)
+    return await cache.base_cache_key_func(*key_args) + f'-{checksum}-{PARSER_VERSION}'
+
+
+async def get_document_fields(paperless_doc: paperless.PaperlessDocument, client: paperless.PaperlessClient) -> dict[str, Any]:
+    # Document fields taken from paperless, ie. everything except pages and parse status
     correspondents_by_id = await client.correspondents_by_id
     document_types_by_id = await client.document_types_by_id
-    paperless_doc = await client.get_document_by_id(paperless_id)
-
-    # Get pdf page data in thread because it might block the event loop
-    pdf_data = await async_iter_to_bytes(get_pdf_data(paperless_id, preprocess))
-    pages, error = await asyncio.get_running_loop().run_in_executor(None, get_pdf_pages, paperless_doc, pdf_data)
 
-    correspondent = correspondents_by_id[paperless_doc.correspondent].name if paperless_doc.correspondent else None
-    document_type = document_types_by_id[paperless_doc.document_type].name if paperless_doc.document_type else None
-    document = Document(
-        id=paperless_id,
+    return dict(
+        id=paperless_doc.id,
         title=paperless_doc.title,
-        correspondent=correspondent,
-        document_type=document_type,
+        correspondent=correspondents_by_id[paperless_doc.correspondent].name if paperless_doc.correspondent else None,
+        document_type=document_types_by_id[paperless_doc.document_type].name if paperless_doc.document_type else None,
         datetime_added=paperless_doc.added,
         date_created=paperless_doc.created,
-        paperless_url=pydantic.TypeAdapter(pydantic.AnyHttpUrl).validate_strings(f'{paperless.PAPERLESS_URL}/documents/{paperless_id}/details'),
-        pages=pages,
-        parse_status=DocumentParseStatus(datetime_parsed=datetime.datetime.now().astimezone(), error=error)
+        paperless_url=pydantic.TypeAdapter(pydantic.AnyHttpUrl).validate_strings(f'{paperless.PAPERLESS_URL}/documents/{paperless_doc.id}/details')
+    )
+
+
+async def create_document(paperless_doc: paperless.PaperlessDocument, parser: DocumentParser, client: paperless.PaperlessClient) -> Document:
+    # Creates a document with metadata and page count only, pages are parsed on demand
+    num_pages = await parser.get_page_count()
+
+    document = Document(
+        **await get_document_fields(paperless_doc, client),
+        pages=[],
+        parse_status=DocumentParseStatus(datetime_parsed=datetime.datetime.now().astimezone(), error=None)
     )
+    document.pages = LazyPages(num_pages, None, unparsed=range(num_pages))
     return document
 
 
-async def get_parsed_document_for_paperless_document_cache_key_func(paperless_doc: paperless.PaperlessDocument, preprocess: 'PreprocessType', client: paperless.PaperlessClient | None = None) -> str:
-    return await cache.base_cache_key_func(paperless_doc.id, preprocess) + '-' + str(paperless_doc.modified)
+async def load_cached_document(key: str) -> Document | None:
+    data = await cache.PARSED_DOCUMENT_CACHE.get_async(key)
+    if data is None:
+        return None
+    try:
+        if is_partially_parsed_document(data):
+            # Parsing continues on this instance, so it isn't memoized (and shared)
+            return Document.from_bytes(data)
+        return cache.parse_binary_model(Document, data)
+    except cache.CacheFormatError as e:
+        log.info(f'Discarding cache entry {key}: {e}')
+        return None
 
 
-@cache.pydantic_yaml_cache(Document, 'parsed_document', cache_key_func=get_parsed_document_for_paperless_document_cache_key_func)
-async def get_parsed_document_for_paperless_document(paperless_doc: paperless.PaperlessDocument, preprocess: 'PreprocessType', *, client: paperless.PaperlessClient | None = None) -> Document:
-    return await get_parsed_document(paperless_doc.id, preprocess, client=client)
+async def store_cached_document(key: str, doc: Document):
+    if isinstance(doc.pages, LazyPages) and doc.pages.unparsed:
+        # Another caller may have parsed other pages of the document in the meantime, merge them in
+        cached_doc = await load_cached_document(key)
+        if cached_doc is not None and cached_doc.is_fully_parsed:
+            return
+        if cached_doc is not None and isinstance(cached_doc.pages, LazyPages) and len(cached_doc.pages) == len(doc.pages):
+            doc.pages.set_parsed([cached_doc.pages[page_nr] for page_nr in doc.pages.unparsed - cached_doc.pages.unparsed])
 
+    await cache.PARSED_DOCUMENT_CACHE.set_async(key, doc.to_bytes())
 
-async def get_page_svg_cache_key_func(paperless_id: int, page_nr: int) -> str:
-    client = paperless.PaperlessClient()
-    return await cache.base_cache_key_func(paperless_id, page_nr) + '-' + str(await client.get_document_modified_date(paperless_id))
 
+async def get_parsed_document_for_paperless_document_cache_key_func(paperless_doc: paperless.PaperlessDocument, preprocess: 'PreprocessType', client: paperless.PaperlessClient | None = None) -> str:
+    return await get_parsed_document_cache_key(paperless_doc.id, preprocess, await get_document_checksum(paperless_doc.id, client, paperless_doc.modified))
 
-@cache.stream_cache('pdf_page_svg', cache_key_func=get_page_svg_cache_key_func) # type: ignore
-async def get_pdf_page_svg(paperless_id: int, page_nr: int) -> AsyncIterable[bytes]:
-    proc: asyncio.subprocess.Process = await asyncio.create_subprocess_exec('/usr/bin/pdftocairo', '-svg', '-f', str(page_nr + 1), '-l', str(page_nr + 1), '-', '-', stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
-    assert proc.stdout is not None
 
-    async def feed_input():
-        assert proc.stdin is not None
-        async for chunk in get_pdf_data(paperless_id, None):
-            proc.stdin.write(chunk)
-            await proc.stdin.drain()
-        proc.stdin.close()
-        await proc.stdin.wait_closed()
+@asynccontextmanager
+async def open_parsed_document(paperless_id: int, preprocess: 'PreprocessType', *, client: paperless.PaperlessClient | None = None, paperless_doc: paperless.PaperlessDocument | None = None) -> AsyncGenerator[Document, None]:
+    # Yields the document, whose pages may only be partially parsed (see Document.load_pages()).
+    # Pages parsed while the context is open are added to the cached document on exit, so that
+    # later calls resume where this one stopped.
+    client = client or paperless.PaperlessClient()
+    paperless_doc = paperless_doc or await client.get_document_by_id(paperless_id)
+    key = await get_parsed_document_for_paperless_document_cache_key_func(paperless_doc, preprocess, client)
+
+    doc = await load_cached_document(key)
+    if doc is not None:
+        # The cache key does not change with metadata, so update it from paperless. The cached instance
+        # may be shared with other callers, so it is copied rather than updated in place.
+        doc = doc.model_copy(update=await get_document_fields(paperless_doc, client))
 
-    # Start feeding in the background
-    feeder = asyncio.create_task(feed_input())
+    if doc is None or not doc.is_fully_parsed:
+        parser = DocumentParser(paperless_doc, preprocess)
+        if doc is None:
+            doc = await create_document(paperless_doc, parser, client)
+        doc.attach_parser(parser)
 
     try:
-        while True:
-            chunk = await proc.stdout.read(65536)
-            if not chunk:
-                break
-            yield chunk
+        yield doc
     finally:
-        await feeder
-        await proc.wait()
+        doc.close_parser()
+        if isinstance(doc.pages, LazyPages) and doc.pages.has_new_pages:
+            doc.pages.has_new_pages = False
+            await store_cached_document(key, doc)
+
+
+async def get_parsed_document(paperless_id: int, preprocess: 'PreprocessType', *, client: paperless.PaperlessClient | None = None) -> Document:
+    async with open_parsed_document(paperless_id, preprocess, client=client) as doc:
+        await doc.load_all_pages()
+    return doc
+
+
+async def get_parsed_document_for_paperless_document(paperless_doc: paperless.PaperlessDocument, preprocess: 'PreprocessType', *, client: paperless.PaperlessClient | None = None) -> Document:
+    async with open_parsed_document(paperless_doc.id, preprocess, client=client, paperless_doc=paperless_doc) as doc:
+        await doc.load_all_pages()
+    return doc
+
+
+async def get_page_svg_cache_key(paperless_id: int, page_nr: int, checksum: str) -> str:
+    return await cache.base_cache_key_func(paperless_id, page_nr) + '-' + checksum
+
+
+SVG_PREFETCH_PAGES: int = int(os.environ.get('SVG_PREFETCH_PAGES', '2')) # pages before and after the requested page
+SVG_RENDER_JOB_IDLE_TIMEOUT: float = 60 # seconds
+
+
+class SvgRenderJob:
+    """Renders the pages of a document to SVG from the PDF store, so the PDF is downloaded at most once for all pages.
+
+    Rendered pages are stored in the pdf_page_svg cache. After a page is requested, the pages around it are
+    rendered in the background. The job is closed (allowing eviction of the PDF) once it has been idle for a while.
+    """
+
+    def __init__(self, paperless_id: int, checksum: str):
+        self.paperless_id = paperless_id
+        self.checksum = checksum
+        self.pdf_path: str | None = None
+        self.num_pages: int | None = None
+        self.download_lock = asyncio.Lock()
+        self.renders: dict[int, asyncio.Task[bytes]] = {}
+        self.prefetch_task: asyncio.Task[None] | None = None
+        self.idle_timer: asyncio.TimerHandle | None = None
+        self.touch()
+
+    def touch(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = asyncio.get_running_loop().call_later(SVG_RENDER_JOB_IDLE_TIMEOUT, self.close)
+
+    def close(self):
+        if self.renders or (self.prefetch_task is not None and not self.prefetch_task.done()):
+            self.touch() # still rendering
+            return
+
+        if _svg_render_jobs.get((self.paperless_id, self.checksum)) is self:
+            del _svg_render_jobs[(self.paperless_id, self.checksum)]
+        if self.pdf_path is not None:
+            PDF_STORE.release(self.checksum)
+            self.pdf_path = None
+
+    async def get_pdf_path(self) -> str:
+        async with self.download_lock:
+            if self.pdf_path is None:
+                pdf_path = str(await PDF_STORE.acquire(self.checksum, functools.partial(download_pdf, self.paperless_id)))
+                self.num_pages = await asyncio.get_running_loop().run_in_executor(get_pdf_parse_executor(), get_pdf_page_count, pdf_path)
+                self.pdf_path = pdf_path
+            return self.pdf_path
+
+    async def render_page(self, page_nr: int) -> bytes:
+        self.touch()
+        task = self.renders.get(page_nr)
+        if task is None:
+            task = self.renders[page_nr] = asyncio.create_task(self._render_page(page_nr))
+            task.add_done_callback(lambda _t: self.renders.pop(page_nr, None))
+        return await asyncio.shield(task) # keep rendering for the cache if the request is cancelled
+
+    async def _render_page(self, page_nr: int) -> bytes:
+        key = await get_page_svg_cache_key(self.paperless_id, page_nr, self.checksum)
+        data: bytes | None = await cache.cache_get_async(cache.CACHES['pdf_page_svg'], key)
+        if data is not None:
+            return data
+
+        pdf_path = await self.get_pdf_path()
+        proc = await asyncio.create_subprocess_exec('/usr/bin/pdftocairo', '-svg', '-f', str(page_nr + 1), '-l', str(page_nr + 1), pdf_path, '-', stdout=asyncio.subprocess.PIPE)
+        data, _ = await proc.communicate()
+        if proc.returncode == 0:
+            await cache.cache_set_async(cache.CACHES['pdf_page_svg'], key, data, None)
+        return data
+
+    def prefetch(self, page_nr: int):
+        # Replaces prefetching of the previously requested page
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+        self.prefetch_task = asyncio.create_task(self._prefetch(page_nr))
+
+    async def _prefetch(self, page_nr: int):
+        page_nrs = [n for distance in range(1, SVG_PREFETCH_PAGES + 1) for n in (page_nr + distance, page_nr - distance) if n >= 0]
+        for n in page_nrs:
+            if self.num_pages is not None and n >= self.num_pages:
+                continue
+            try:
+                await self.render_page(n)
+            except Exception:
+                log.exception(f'Exception prefetching page {n} of document {self.paperless_id}')
+                return
+
+
+_svg_render_jobs: dict[tuple[int, str], SvgRenderJob] = {}
+
+
+def get_svg_render_job(paperless_id: int, checksum: str) -> SvgRenderJob:
+    job = _svg_render_jobs.get((paperless_id, checksum))
+    if job is None:
+        job = _svg_render_jobs[(paperless_id, checksum)] = SvgRenderJob(paperless_id, checksum)
+    return job
+
+
+async def get_pdf_page_svg(paperless_id: int, page_nr: int) -> AsyncIterable[bytes]:
+    checksum = await get_document_checksum(paperless_id)
+    job = get_svg_render_job(paperless_id, checksum)
+
+    key = await get_page_svg_cache_key(paperless_id, page_nr, checksum)
+    reader = await cache.cache_get_async(cache.CACHES['pdf_page_svg'], key, read=True)
+    if isinstance(reader, bytes): # small values are stored in the cache database rather than in files
+        yield reader
+    elif reader is not None:
+        with reader:
+            while True:
+                chunk = reader.read(64000)
+                if not chunk:
+                    break
+                yield chunk
+    else:
+        yield await job.render_page(page_nr)
+
+    job.prefetch(page_nr)
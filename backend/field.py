@@ -1,4 +1,6 @@
 import decimal
+import os
+import functools
 import datetime
 import pydantic
 import jinja2
@@ -35,6 +37,23 @@ class FieldResult(pydantic.BaseModel):
     error: str | None
 
 
+FIELD_TEMPLATE_CACHE_SIZE = int(os.environ.get('FIELD_TEMPLATE_CACHE_SIZE', '1024'))
+
+
+@functools.cache
+def get_template_environment() -> jinja2.sandbox.SandboxedEnvironment:
+    # Shared by all fields, templates do not modify the environment
+    env = jinja2.sandbox.SandboxedEnvironment()
+    env.filters['parse_monetary'] = parse_monetary # type: ignore
+    env.filters['parse_date'] = parse_date         # type: ignore
+    return env
+
+
+@functools.lru_cache(maxsize=FIELD_TEMPLATE_CACHE_SIZE)
+def compile_template(source: str) -> jinja2.Template:
+    return get_template_environment().from_string(source)
+
+
 class Field(pydantic.BaseModel):
     kind: Literal['attr', 'custom'] = 'custom'
     name: str
@@ -42,11 +61,8 @@ class Field(pydantic.BaseModel):
 
     def render(self, region_values: dict[str, str]) -> FieldResult:
         try:
-            env = jinja2.sandbox.SandboxedEnvironment()
-            env.filters['parse_monetary'] = parse_monetary # type: ignore
-            env.filters['parse_date'] = parse_date         # type: ignore
-            template = env.from_string(self.template)
-            value = template.render(**region_values)
+            template = compile_template(self.template)
+            value = template.render(region_values)
             error = None
         except jinja2.exceptions.TemplateError as e:
             value = None
@@ -57,36 +73,49 @@ class Field(pydantic.BaseModel):
         return FieldResult(value=value, error=error)
 
     async def get_result(self, client: paperless.PaperlessClient, region_values: dict[str, str]) -> FieldResult:
-        custom_fields_by_name = await client.custom_fields_by_name
-
-        field_result = self.render(region_values)
-        if not field_result.error:
-            if self.kind == 'custom':
-                if not self.name in custom_fields_by_name:
-                    field_result.error = f'Field {self.name} not found'
-                else:
-                    field_def = custom_fields_by_name[self.name]
-                    field_result.data_type = field_def.data_type
-                    try:
-                        if field_result.value is not None:
-                            converted_value = field_def.convert_value_to_paperless(field_result.value)
-                            field_result.value = str(converted_value)
-                    except paperless.PaperlessValueConversionException as e:
-                        field_result.value = None
-                        field_result.error = str(e)
-
-            if self.kind == 'attr':
-                attributes = await client.get_element_list('attributes')
-                attribute = next(iter(filter(lambda a: a.name == self.name, attributes)), None)
-                if attribute is None:
-                    field_result.error = f'Attribute {self.name} not found'
-                else:
-                    attribute = cast(paperless.PaperlessAttribute, attribute)
-                    try:
-                        if field_result.value is not None:
-                            converted_value = paperless.value_to_paperless(attribute.data_type, field_result.value)
-                            field_result.value = str(converted_value)
-                    except paperless.PaperlessValueConversionException as e:
-                        field_result.value = None
-                        field_result.error = str(e)
-        return field_result
+        return (await get_field_results([self], client, region_values))[0]
+
+
+def render_fields(fields: list[Field], region_values: dict[str, str]) -> list[FieldResult]:
+    return [f.render(region_values) for f in fields]
+
+
+async def get_field_results(fields: list[Field], client: paperless.PaperlessClient, region_values: dict[str, str]) -> list[FieldResult]:
+    # Renders all fields (eg. of a pattern) against the same region values and converts the values to their paperless data types
+    custom_fields_by_name = await client.custom_fields_by_name
+    attributes = await client.get_element_list('attributes') if any(f.kind == 'attr' for f in fields) else []
+
+    field_results = render_fields(fields, region_values)
+    for f, field_result in zip(fields, field_results):
+        if field_result.error:
+            continue
+
+        if f.kind == 'custom':
+            if not f.name in custom_fields_by_name:
+                field_result.error = f'Field {f.name} not found'
+            else:
+                field_def = custom_fields_by_name[f.name]
+                field_result.data_type = field_def.data_type
+                try:
+                    if field_result.value is not None:
+                        converted_value = field_def.convert_value_to_paperless(field_result.value)
+                        field_result.value = str(converted_value)
+                except paperless.PaperlessValueConversionException as e:
+                    field_result.value = None
+                    field_result.error = str(e)
+
+        if f.kind == 'attr':
+            attribute = next(iter(filter(lambda a: a.name == f.name, attributes)), None)
+            if attribute is None:
+                field_result.error = f'Attribute {f.name} not found'
+            else:
+                attribute = cast(paperless.PaperlessAttribute, attribute)
+                try:
+                    if field_result.value is not None:
+                        converted_value = paperless.value_to_paperless(attribute.data_type, field_result.value)
+                        field_result.value = str(converted_value)
+                except paperless.PaperlessValueConversionException as e:
+                    field_result.value = None
+                    field_result.error = str(e)
+
+    return field_results
@@ -4,12 +4,16 @@ from typing import Literal
 import pathlib
 from aiofile import async_open
 import yaml
+import asyncio
 
 
 HISTORY_PATH = pathlib.Path('../data/history').resolve()
 
 MAX_HISTORY_SIZE = 50
 
+# Serializes read-modify-write of the history file, documents may be saved concurrently
+_history_lock = asyncio.Lock()
+
 
 class HistoryItem(pydantic.BaseModel):
     id: int
@@ -44,10 +48,11 @@ async def save_history(history: History):
 
 
 async def add_history_item(item: HistoryItem):
-    history = await get_history()
-    history.root.append(item)
-    history.root = history.root[-MAX_HISTORY_SIZE:]
-    await save_history(history)
+    async with _history_lock:
+        history = await get_history()
+        history.root.append(item)
+        history.root = history.root[-MAX_HISTORY_SIZE:]
+        await save_history(history)
 
 
 async def history_log_update(paperless_id: int, title: str, details: str) -> HistoryItem:
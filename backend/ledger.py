@@ -0,0 +1,54 @@
+import pydantic
+import pathlib
+import logging
+import paperless
+
+log = logging.getLogger('uvicorn')
+
+
+LEDGER_FILE_PATH = pathlib.Path('../data/state/ledger.json').resolve()
+LEDGER_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+
+class PatternRecord(pydantic.BaseModel):
+    fingerprint: str
+    matched: bool
+
+
+class DocumentRecord(pydantic.BaseModel):
+    modified: pydantic.AwareDatetime
+    patterns: dict[str, PatternRecord]
+
+
+class Ledger(pydantic.BaseModel):
+    # Records which patterns (by fingerprint) were applied to each document in which state (by modification date),
+    # so that unchanged (document, pattern) pairs can be skipped by the next run of process_all_documents().
+    documents: dict[int, DocumentRecord] = {}
+
+    @classmethod
+    def load(cls) -> 'Ledger':
+        try:
+            return cls.model_validate_json(LEDGER_FILE_PATH.read_bytes())
+        except FileNotFoundError:
+            return cls()
+        except Exception as e:
+            log.error(f'Error loading ledger.json, all documents will be processed: {e}')
+            return cls()
+
+    def save(self):
+        try:
+            tmp_file = (LEDGER_FILE_PATH.parent / 'ledger.json.tmp').resolve()
+            tmp_file.write_text(self.model_dump_json())
+            tmp_file.rename(LEDGER_FILE_PATH)
+        except Exception as e:
+            log.error(f'Error saving ledger.json: {e}')
+
+    def get_unchanged_patterns(self, paperless_doc: paperless.PaperlessDocument, fingerprints: dict[str, str]) -> dict[str, PatternRecord]:
+        # Records of the patterns that were applied to the document in its current state, and have not changed since
+        record = self.documents.get(paperless_doc.id)
+        if record is None or record.modified != paperless_doc.modified:
+            return {}
+        return { name: r for name, r in record.patterns.items() if fingerprints.get(name) == r.fingerprint }
+
+    def record(self, document_id: int, modified: pydantic.AwareDatetime, patterns: dict[str, PatternRecord]):
+        self.documents[document_id] = DocumentRecord(modified=modified, patterns=patterns)
@@ -36,7 +36,10 @@ async def lifespan(app: FastAPI):
     if matching.lockfile_path.exists():
         matching.lockfile_path.unlink(missing_ok=True)
         log.info(f'Deleted stale lock file "{matching.lockfile_path}"')
+    await paperless.open_session()
     yield
+    await paperless.close_session()
+    document.shutdown_pdf_parse_executor()
 
 prefix_app = FastAPI(lifespan=lifespan)
 api_app = FastAPI()
@@ -101,7 +104,7 @@ async def evaluate_pattern(document_id: int, p: pattern.Pattern) -> pattern.Patt
 async def evaluate_region(document_id: int, region: region.Region, preprocess: pattern.PreprocessType = None) -> list[region.RegionResult]: # 1 result per page
     client = paperless.PaperlessClient()
     doc = await document.get_parsed_document(document_id, preprocess, client=client)
-    return doc.evaluate_regions([region])[0]
+    return (await doc.evaluate_regions([region]))[0]
 
 
 @api_app.get('/document/{document_id}')
@@ -164,6 +167,11 @@ async def get_processing_results():
     return FileResponse(results.RESULTS_FILE_PATH, media_type='application/json', headers={ 'Cache-Control': 'no-cache, no-store, must-revalidate', 'Pragma': 'no-cache', 'Expires': '0' })
 
 
+@api_app.get('/paperless_limits')
+async def get_paperless_limits() -> list[paperless.LimiterStatus]:
+    return paperless.get_limiter_status()
+
+
 @api_app.get('/paperless_element/{slug}')
 async def get_paperless_element_list(slug: str) -> list[paperless.PaperlessNamedElement | paperless.PaperlessAttribute]:
     return await paperless.PaperlessClient().get_element_list(slug)
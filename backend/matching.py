@@ -6,15 +6,19 @@ import flufl.lock
 import datetime
 import pathlib
 import itertools
-from typing import AsyncIterable, AsyncIterator, Annotated, Literal, cast
+import hashlib
+import json
+import contextlib
+from typing import AsyncIterable, AsyncIterator, Annotated, Awaitable, Callable, Literal, Mapping, cast
 from pydantic import BaseModel, Field, NaiveDatetime
 # import aiomultiprocess
 import asyncio
 import paperless
-from document import Document, get_parsed_document, get_parsed_document_for_paperless_document
-from pattern import Pattern, list_patterns, get_pattern
+from document import Document, open_parsed_document
+from pattern import Pattern, PreprocessType, get_pattern_index
 from history import history_log_update
 from results import ProcessingResults
+from ledger import Ledger, PatternRecord
 
 logging.basicConfig()
 log = logging.getLogger('uvicorn')
@@ -48,12 +52,23 @@ POST_PROCESS_ADD_TAGS =    [t.strip() for t in os.environ.get('POST_PROCESS_CHAN
 POST_PROCESS_REMOVE_TAGS = [t.strip().lstrip('-') for t in os.environ.get('POST_PROCESS_CHANGE_TAGS', '').split(',') if t.strip() != '' and t.strip().startswith('-')]
 POST_PROCESS_DONT_SAVE = os.environ.get('POST_PROCESS_DONT_SAVE', 'False').lower() == 'true'
 
+# Worker counts of the process_all_documents() pipeline stages, and size of the queues between them
+PROCESSING_FETCH_WORKERS: int = int(os.environ.get('PROCESSING_FETCH_WORKERS', '4'))
+PROCESSING_EVALUATE_WORKERS: int = int(os.environ.get('PROCESSING_EVALUATE_WORKERS', '4'))
+PROCESSING_SAVE_WORKERS: int = int(os.environ.get('PROCESSING_SAVE_WORKERS', '2'))
+PROCESSING_QUEUE_SIZE: int = int(os.environ.get('PROCESSING_QUEUE_SIZE', '16'))
+
 
 async def filter_documents_matching_pattern(paperless_docs: AsyncIterable[paperless.PaperlessDocument], pattern: Pattern, client: paperless.PaperlessClient) -> AsyncIterator[Document]:
     async for paperless_doc in paperless_docs:
-        doc = await get_parsed_document_for_paperless_document(paperless_doc, pattern.preprocess, client=client)
-        
-        if await pattern.checks_match(doc, paperless_doc, client):
+        if await pattern.match_metadata(paperless_doc, client) is False:
+            continue # Decided without downloading or parsing the document
+
+        # Only the pages needed to decide the checks are parsed
+        async with open_parsed_document(paperless_doc.id, pattern.preprocess, client=client, paperless_doc=paperless_doc) as doc:
+            matches = await pattern.checks_match(doc, paperless_doc, client)
+
+        if matches:
             yield doc
 
 
@@ -79,16 +94,19 @@ async def filter_documents_matching_pattern(paperless_docs: AsyncIterable[paperl
 async def get_documents_matching_pattern(pattern: Pattern, all_documents: bool = False) -> AsyncIterator[Document]:
     client = paperless.PaperlessClient()
 
-    # Find topmost correspondent and document type checks and use them in paperless query.
-    # This reduces the number of results needing to be checked significantly in the most common case.
-    correspondents, document_types = pattern.get_required_correspondents_and_document_types()
+    # Checks expressible as paperless filters are pushed down into the query, so that paperless returns (nearly) only
+    # matching documents. Only the remaining checks are evaluated locally.
+    document_query = await pattern.get_document_query(client)
+    if document_query is None:
+        return # No document can match
+    query, residual_checks = document_query
 
     required_tags = [] if all_documents else PAPERLESS_REQUIRED_TAGS
     excluded_tags = [] if all_documents else PAPERLESS_EXCLUDED_TAGS
 
-    paperless_docs = client.get_documents_with_tags(required_tags, excluded_tags, correspondents=correspondents, document_types=document_types)
+    paperless_docs = client.get_documents_with_tags(required_tags, excluded_tags, query=query)
 
-    async for doc in filter_documents_matching_pattern(paperless_docs, pattern, client):
+    async for doc in filter_documents_matching_pattern(paperless_docs, pattern.with_checks(residual_checks), client):
         yield doc
 
 
@@ -97,16 +115,66 @@ lockfile_path.parent.mkdir(parents=True, exist_ok=True)
 processing_lock = flufl.lock.Lock(str(lockfile_path), lifetime=datetime.timedelta(hours=24))  # pyright: ignore[reportPrivateImportUsage]
 
 
+def get_pattern_fingerprint(pattern: Pattern) -> str:
+    # Changes whenever the pattern or the post-processing settings change, used to find documents to reprocess
+    data = pattern.model_dump_json() + json.dumps([POST_PROCESS_ADD_TAGS, POST_PROCESS_REMOVE_TAGS, POST_PROCESS_DONT_SAVE])
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+async def run_pipeline_stage[T, U](inputs: asyncio.Queue[T | None], outputs: asyncio.Queue[U | None] | None, func: Callable[[T], Awaitable[U | None]], num_workers: int):
+    # Runs func on inputs with num_workers concurrent workers until a None item is received. Results other than None
+    # are put on the outputs queue, which is bounded so that a slow stage holds back the ones before it.
+    async def worker():
+        while (item := await inputs.get()) is not None:
+            result = await func(item)
+            if outputs is not None and result is not None:
+                await outputs.put(result)
+        await inputs.put(None) # Let the other workers stop too
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(max(1, num_workers)):
+            tg.create_task(worker())
+
+    if outputs is not None:
+        await outputs.put(None)
+
+
+class FetchedDocument:
+    """A document with the patterns still to be applied to it, opened once for each preprocessing they need."""
+
+    def __init__(self, index: int, paperless_doc: paperless.PaperlessDocument, patterns: list[Pattern]):
+        self.index = index
+        self.paperless_doc = paperless_doc
+        self.patterns = patterns
+        self.documents: dict[PreprocessType, Document] = {}
+        self.exit_stack = contextlib.AsyncExitStack()
+
+    async def open(self, client: paperless.PaperlessClient):
+        # Downloads (and OCRs) the PDFs and loads the cached pages. Patterns decided on metadata alone need neither.
+        try:
+            for pattern in self.patterns:
+                if pattern.preprocess not in self.documents and await pattern.match_metadata(self.paperless_doc, client) is not False:
+                    self.documents[pattern.preprocess] = await self.exit_stack.enter_async_context(
+                        open_parsed_document(self.paperless_doc.id, pattern.preprocess, client=client, paperless_doc=self.paperless_doc))
+        except BaseException:
+            await self.close()
+            raise
+
+    async def close(self):
+        await self.exit_stack.aclose()
+        self.documents = {}
+
+
 async def process_all_documents():
     try:
         with processing_lock:
             results = ProcessingResults()  # type: ignore
 
             start_time = datetime.datetime.now()
-            num_docs = 0
             log.info(f'Processing all documents with tags {PAPERLESS_REQUIRED_TAGS}')
 
-            patterns = [await get_pattern(p.name) for p in await list_patterns()]
+            pattern_index = await get_pattern_index()
+            patterns = pattern_index.patterns
             log.debug(f'Loaded {len(patterns)} patterns')
 
             client = paperless.PaperlessClient()
@@ -117,11 +185,120 @@ async def process_all_documents():
                 log.error(f'Tag with name "{e.args[0]}" used in PAPERLESS_REQUIRED_TAGS or POST_PROCESS_CHANGE_TAGS does not exist')
                 return
 
-            async for paperless_doc in client.get_documents_with_tags(PAPERLESS_REQUIRED_TAGS, PAPERLESS_EXCLUDED_TAGS):
-                await process_document(paperless_doc, client, patterns, results)
-                num_docs += 1
+            # Documents are listed, fetched (downloaded and opened), evaluated (parsing pages as needed) and saved in
+            # concurrent stages. Each document gets its own results, merged in listing order once done so that results
+            # are deterministic. Errors are registered per document, so that a failing document doesn't abort the run.
+            doc_results: list[ProcessingResults] = []
+            fetch_queue: asyncio.Queue[tuple[int, paperless.PaperlessDocument] | None] = asyncio.Queue(PROCESSING_QUEUE_SIZE)
+            evaluate_queue: asyncio.Queue[FetchedDocument | None] = asyncio.Queue(PROCESSING_QUEUE_SIZE)
+            save_queue: asyncio.Queue[tuple[int, paperless.PaperlessDocument, list[Pattern]] | None] = asyncio.Queue(PROCESSING_QUEUE_SIZE)
+
+            # Patterns already applied to a document in its current state are not applied again, their outcome is taken from the ledger
+            fingerprints = { p.name: get_pattern_fingerprint(p) for p in patterns if p.enabled }
+            pattern_order = { p.name: i for i, p in enumerate(patterns) }
+            previous_ledger = Ledger.load()
+            ledger = Ledger()
+            num_skipped = 0
+
+            def record_document(paperless_doc: paperless.PaperlessDocument, doc_result: ProcessingResults, modified: datetime.datetime):
+                # Patterns with errors are not recorded so that they are retried by the next run
+                failed = { e.pattern_name for e in doc_result.errors }
+                matched = doc_result.matched_patterns.get(paperless_doc.id, [])
+                ledger.record(paperless_doc.id, modified, { name: PatternRecord(fingerprint=fingerprint, matched=name in matched) for name, fingerprint in fingerprints.items() if name not in failed })
+
+            async def list_documents():
+                async for paperless_doc in client.get_documents_with_tags(PAPERLESS_REQUIRED_TAGS, PAPERLESS_EXCLUDED_TAGS):
+                    doc_results.append(ProcessingResults())  # type: ignore
+                    await fetch_queue.put((len(doc_results) - 1, paperless_doc))
+                await fetch_queue.put(None)
+
+            def register_document_error(paperless_doc: paperless.PaperlessDocument, doc_result: ProcessingResults, pattern_names: list[str], e: Exception):
+                # The document is not recorded, so that it is retried by the next run
+                log.exception(f'Exception while processing document {paperless_doc.id}')
+                for pattern_name in pattern_names:
+                    doc_result.register_error(paperless_doc.id, paperless_doc.title, pattern_name, str(e))
+
+            async def fetch(item: tuple[int, paperless.PaperlessDocument]) -> FetchedDocument | None:
+                index, paperless_doc = item
+                doc_result = doc_results[index]
+                pending_names = list(fingerprints)
+                try:
+                    unchanged = previous_ledger.get_unchanged_patterns(paperless_doc, fingerprints)
+                    for name, record in unchanged.items():
+                        if record.matched:
+                            doc_result.register_match(paperless_doc.id, paperless_doc.title, name)
+
+                    # Patterns that cannot match the document (per the pattern index) are recorded as not matched
+                    pending_names = [name for name in fingerprints if name not in unchanged]
+                    pending_patterns = [p for p in await pattern_index.get_candidates(paperless_doc, client) if p.name in pending_names] if pending_names else []
+
+                    fetched = FetchedDocument(index, paperless_doc, pending_patterns)
+                    await fetched.open(client)
+                    return fetched
+                except Exception as e:
+                    register_document_error(paperless_doc, doc_result, pending_names, e)
+                    return None
+
+            async def evaluate(fetched: FetchedDocument) -> tuple[int, paperless.PaperlessDocument, list[Pattern]] | None:
+                nonlocal num_skipped
+                paperless_doc = fetched.paperless_doc
+                doc_result = doc_results[fetched.index]
+
+                matched_patterns: list[Pattern] = []
+                paperless_doc_has_changed = False
+                try:
+                    if fetched.patterns:
+                        applied = await apply_patterns(paperless_doc, client, fetched.patterns, doc_result, fetched.documents)
+                        if applied is None:
+                            return None # Not recorded, retried by the next run
+                        matched_patterns, paperless_doc_has_changed = applied
+                    else:
+                        num_skipped += 1
+                except Exception as e:
+                    register_document_error(paperless_doc, doc_result, [p.name for p in fetched.patterns], e)
+                    return None
+                finally:
+                    await fetched.close()
+
+                if matched_pattern_names := doc_result.matched_patterns.get(paperless_doc.id):
+                    matched_pattern_names.sort(key=lambda name: pattern_order[name])
+                else:
+                    doc_result.register_unmatched(paperless_doc.id, paperless_doc.title)
+
+                if paperless_doc_has_changed:
+                    return fetched.index, paperless_doc, matched_patterns
+
+                record_document(paperless_doc, doc_result, paperless_doc.modified)
+                return None
+
+            async def save(item: tuple[int, paperless.PaperlessDocument, list[Pattern]]) -> None:
+                index, paperless_doc, matched_patterns = item
+                try:
+                    updated_doc = await save_document(paperless_doc, client, matched_patterns, doc_results[index])
+                except Exception as e:
+                    register_document_error(paperless_doc, doc_results[index], [p.name for p in matched_patterns], e)
+                    return
+                record_document(paperless_doc, doc_results[index], updated_doc.modified if updated_doc else paperless_doc.modified)
+
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(list_documents())
+                    tg.create_task(run_pipeline_stage(fetch_queue, evaluate_queue, fetch, PROCESSING_FETCH_WORKERS))
+                    tg.create_task(run_pipeline_stage(evaluate_queue, save_queue, evaluate, PROCESSING_EVALUATE_WORKERS))
+                    tg.create_task(run_pipeline_stage(save_queue, None, save, PROCESSING_SAVE_WORKERS))
+            except BaseException:
+                # Keep the records of documents not reached by this run
+                for document_id, document_record in previous_ledger.documents.items():
+                    ledger.documents.setdefault(document_id, document_record)
+                raise
+            finally:
+                ledger.save()
+
+            for doc_result in doc_results:
+                results.merge(doc_result)
+            num_docs = len(doc_results)
             end_time = datetime.datetime.now()
-            log.info(f'Processed {num_docs} documents in {end_time - start_time}')
+            log.info(f'Processed {num_docs} documents ({num_skipped} without patterns to apply) in {end_time - start_time}')
             # from results import add_test_data
             # add_test_data(results)
             # add_test_data(results)
@@ -145,9 +322,24 @@ async def process_document(paperless_doc: paperless.PaperlessDocument, client: p
         results = ProcessingResults()  # type: ignore
 
     if patterns is None:
-        patterns = [await get_pattern(p.name) for p in await list_patterns()]
-        log.debug(f'Loaded {len(patterns)} patterns')
+        patterns = await (await get_pattern_index()).get_candidates(paperless_doc, client)
+        log.debug(f'Found {len(patterns)} candidate patterns')
+
+    applied = await apply_patterns(paperless_doc, client, patterns, results)
+    if applied is None:
+        return
+    matched_patterns, paperless_doc_has_changed = applied
+
+    if not matched_patterns:
+        results.register_unmatched(paperless_doc.id, paperless_doc.title)
+
+    if paperless_doc_has_changed:
+        await save_document(paperless_doc, client, matched_patterns, results)
+
 
+async def apply_patterns(paperless_doc: paperless.PaperlessDocument, client: paperless.PaperlessClient, patterns: list[Pattern], results: ProcessingResults, documents: Mapping[PreprocessType, Document] | None = None) -> tuple[list[Pattern], bool] | None:
+    # Applies the patterns to paperless_doc (without saving it). Returns the matched patterns and whether it has changed,
+    # or None if the document could not be processed. Documents already opened (by preprocessing) are used if given.
     tags_by_name = await client.tags_by_name
     tags_by_id = await client.tags_by_id
     custom_fields_by_id = await client.custom_fields_by_id
@@ -159,7 +351,7 @@ async def process_document(paperless_doc: paperless.PaperlessDocument, client: p
         [tags_by_name[t].id for t in PAPERLESS_REQUIRED_TAGS]
     except KeyError as e:
         log.error(f'Tag with name "{e.args[0]}" used in PAPERLESS_REQUIRED_TAGS or POST_PROCESS_CHANGE_TAGS does not exist')
-        return
+        return None
 
     paperless_doc_has_changed = False
     matched_patterns: list[Pattern] = []
@@ -168,21 +360,34 @@ async def process_document(paperless_doc: paperless.PaperlessDocument, client: p
             continue
 
         try:
-            # Get document (preprocessed if so required by pattern). Returns cached result.
-            doc = await get_parsed_document(paperless_doc.id, pattern.preprocess, client=client)
-            log.debug(f'Loaded cached text runs for document {doc.id}')
+            if await pattern.match_metadata(paperless_doc, client) is False:
+                continue # Decided without downloading or parsing the document
 
-            if doc.parse_status.error != None:
-                log.error(f'Document {doc.id} has parsing error, skipping (may want to delete from cache!)')
-                return
+            # Get document (preprocessed if so required by pattern). Pages are parsed (or loaded from cache) as needed.
+            document_context: contextlib.AbstractAsyncContextManager[Document]
+            if documents and pattern.preprocess in documents:
+                document_context = contextlib.nullcontext(documents[pattern.preprocess])
+            else:
+                document_context = open_parsed_document(paperless_doc.id, pattern.preprocess, client=client, paperless_doc=paperless_doc)
+            async with document_context as doc:
+                log.debug(f'Loaded cached text runs for document {doc.id}')
+
+                if doc.parse_status.error != None:
+                    log.error(f'Document {doc.id} has parsing error, skipping (may want to delete from cache!)')
+                    return None
+
+                matches, result = await pattern.match_and_evaluate(doc, paperless_doc, client, stop_early=True)
+                if doc.parse_status.error != None:
+                    # Pages are parsed during evaluation, don't apply results based on a truncated document
+                    log.error(f'Document {doc.id} has parsing error, skipping (may want to delete from cache!)')
+                    return None
+                if not matches:
+                    continue
 
-            if await pattern.checks_match(doc, paperless_doc, client):
                 log.debug(f'Pattern "{pattern.name}" matches against document {doc.id}')
                 matched_patterns.append(pattern)
                 results.register_match(doc.id, doc.title, pattern.name)
-                # TODO use "doc" instead of "paperless_doc" here
-                result = await pattern.evaluate(paperless_doc.id, pattern.preprocess, client)
-                            
+
                 if any(f and f.error for f in result.fields):
                     errors = "\n".join(f'{field.name}: {field_result.error}' for field_result, field in zip(result.fields, pattern.fields) if field_result and field_result.error)
                     results.register_error(doc.id, doc.title, pattern.name, errors)
@@ -262,25 +467,28 @@ async def process_document(paperless_doc: paperless.PaperlessDocument, client: p
             log.exception('Exception while checking or applying pattern')
             results.register_error(paperless_doc.id, paperless_doc.title, pattern.name, str(e))
 
-    if not matched_patterns:
-        results.register_unmatched(paperless_doc.id, paperless_doc.title)
+    return matched_patterns, paperless_doc_has_changed
 
-    if paperless_doc_has_changed:
 
-        history_field_desc = [f'{custom_fields_by_id[f.field].name}: {f.value}' for f in paperless_doc.custom_fields]
-        history_details = f'Set fields to {", ".join(history_field_desc)}'
-        try:
-            if POST_PROCESS_DONT_SAVE:
-                log.info(f'Did not save document {paperless_doc.id} to Paperless (POST_PROCESS_DONT_SAVE)')
-                log.debug(f'History details: {history_details}')
-            else:
-                await client.put_document(paperless_doc)
-                log.info(f'Saved document {paperless_doc.id} to Paperless')
-        except Exception as e:
-            log.exception(f'Exception saving document {paperless_doc.id}')
-            for pattern in matched_patterns: # Register error for any pattern that matched
-                results.register_error(paperless_doc.id, paperless_doc.title, pattern.name, str(e))
-        await history_log_update(paperless_doc.id, paperless_doc.title, history_details)
+async def save_document(paperless_doc: paperless.PaperlessDocument, client: paperless.PaperlessClient, matched_patterns: list[Pattern], results: ProcessingResults) -> paperless.PaperlessDocument | None:
+    # Returns the updated document if it was saved
+    updated_doc: paperless.PaperlessDocument | None = None
+    custom_fields_by_id = await client.custom_fields_by_id
+    history_field_desc = [f'{custom_fields_by_id[f.field].name}: {f.value}' for f in paperless_doc.custom_fields]
+    history_details = f'Set fields to {", ".join(history_field_desc)}'
+    try:
+        if POST_PROCESS_DONT_SAVE:
+            log.info(f'Did not save document {paperless_doc.id} to Paperless (POST_PROCESS_DONT_SAVE)')
+            log.debug(f'History details: {history_details}')
+        else:
+            updated_doc = await client.put_document(paperless_doc)
+            log.info(f'Saved document {paperless_doc.id} to Paperless')
+    except Exception as e:
+        log.exception(f'Exception saving document {paperless_doc.id}')
+        for pattern in matched_patterns: # Register error for any pattern that matched
+            results.register_error(paperless_doc.id, paperless_doc.title, pattern.name, str(e))
+    await history_log_update(paperless_doc.id, paperless_doc.title, history_details)
+    return updated_doc
 
 
 if __name__ == '__main__':
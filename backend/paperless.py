@@ -11,6 +11,10 @@ import urllib.parse
 import asyncio
 import logging
 import re
+import time
+import random
+import collections
+import email.utils
 from contextlib import asynccontextmanager
 import cache
 
@@ -21,6 +25,17 @@ log = logging.getLogger('uvicorn')
 PAPERLESS_URL: str = os.environ.get('PAPERLESS_URL', 'http://localhost').rstrip('/')
 PAPERLESS_API_TOKEN: str = os.environ.get('PAPERLESS_API_TOKEN', '')
 PAPERLESS_FORCE_SSL: bool = os.environ.get('PAPERLESS_FORCE_SSL', 'False').lower() == 'true'
+PAPERLESS_CONNECTIONS_PER_HOST: int = int(os.environ.get('PAPERLESS_CONNECTIONS_PER_HOST', '10'))
+PAPERLESS_KEEPALIVE_TIMEOUT: float = float(os.environ.get('PAPERLESS_KEEPALIVE_TIMEOUT', '30'))
+PAPERLESS_DNS_CACHE_TTL: int = int(os.environ.get('PAPERLESS_DNS_CACHE_TTL', '300'))
+PAPERLESS_API_CONCURRENCY: int = int(os.environ.get('PAPERLESS_API_CONCURRENCY', '8'))
+PAPERLESS_DOWNLOAD_CONCURRENCY: int = int(os.environ.get('PAPERLESS_DOWNLOAD_CONCURRENCY', '4'))
+PAPERLESS_REQUEST_TRIES: int = int(os.environ.get('PAPERLESS_REQUEST_TRIES', '5'))
+PAPERLESS_RETRY_BASE_DELAY: float = float(os.environ.get('PAPERLESS_RETRY_BASE_DELAY', '1'))
+PAPERLESS_RETRY_MAX_DELAY: float = float(os.environ.get('PAPERLESS_RETRY_MAX_DELAY', '30'))
+
+# Paperless answers with 500 when its db runs out of connections ("sorry, too many clients already")
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
 PaperlessDataT = TypeVar('PaperlessDataT')
@@ -202,6 +217,7 @@ class PaperlessDocument(pydantic.BaseModel):
     is_shared_by_requester: bool
     notes: list[Any]
     custom_fields: list[PaperlessCustomFieldValue]
+    page_count: int | None = None # Not present in older paperless-ngx versions
 
 
 class PaperlessCorrespondent(PaperlessElementBase):
@@ -221,64 +237,208 @@ class PaperlessDocumentModificationDatetime(pydantic.BaseModel):
     modified: pydantic.AwareDatetime
 
 
+class PaperlessDocumentMetadata(pydantic.BaseModel):
+    original_checksum: str
+    archive_checksum: str | None = None
+
+    @property
+    def checksum(self) -> str:
+        # Identifies the file contents, downloads return the archived version if there is one
+        return f'{self.original_checksum}-{self.archive_checksum}' if self.archive_checksum else self.original_checksum
+
+
 def ensure_https(url: str|pydantic.AnyHttpUrl) -> str:
     parts = list(urllib.parse.urlsplit(str(url)))
     parts[0] = 'https'
     return urllib.parse.urlunsplit(parts)
 
 
+_session: aiohttp.ClientSession | None = None
+
+
+async def open_session():
+    # Opens the session shared by all PaperlessClient instances, called on application startup
+    global _session
+    connector = aiohttp.TCPConnector(limit_per_host=PAPERLESS_CONNECTIONS_PER_HOST, keepalive_timeout=PAPERLESS_KEEPALIVE_TIMEOUT, use_dns_cache=True, ttl_dns_cache=PAPERLESS_DNS_CACHE_TTL)
+    _session = aiohttp.ClientSession(connector=connector)
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+@asynccontextmanager
+async def get_session() -> AsyncGenerator[aiohttp.ClientSession, None]:
+    # Uses the shared session if it is open, otherwise (eg. when running matching.py directly) a session for this request only
+    if _session is not None and not _session.closed:
+        yield _session
+    else:
+        async with aiohttp.ClientSession() as session:
+            yield session
+
+
+class LimiterStatus(pydantic.BaseModel):
+    name: str
+    window: int
+    in_flight: int
+    waiting: int
+
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit: the window grows by one per window's worth of successful requests,
+    # and is halved (at most once per PAPERLESS_RETRY_BASE_DELAY) when paperless is overloaded.
+    def __init__(self, name: str, maximum: int):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self._waiters: collections.deque[asyncio.Future[None]] = collections.deque()
+        self._last_decrease = 0.0
+
+    @property
+    def window(self) -> int:
+        return max(1, int(self.limit))
+
+    def status(self) -> LimiterStatus:
+        return LimiterStatus(name=self.name, window=self.window, in_flight=self.in_flight, waiting=len(self._waiters))
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.window:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncGenerator[None, None]:
+        if self.in_flight < self.window and not self._waiters:
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just before cancellation, pass it on
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._wake()
+
+    def on_success(self):
+        window = self.window
+        self.limit = min(self.maximum, self.limit + 1 / window)
+        if self.window > window:
+            log.debug(f'Paperless {self.name} concurrency window increased to {self.window}')
+            self._wake()
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self._last_decrease < PAPERLESS_RETRY_BASE_DELAY:
+            return # Concurrent requests failing together count as one overload
+        self._last_decrease = now
+        self.limit = max(1.0, self.limit / 2)
+        log.warning(f'Paperless {self.name} concurrency window reduced to {self.window}')
+
+
+API_LIMITER = AdaptiveLimiter('api', PAPERLESS_API_CONCURRENCY)
+DOWNLOAD_LIMITER = AdaptiveLimiter('download', PAPERLESS_DOWNLOAD_CONCURRENCY)
+
+
+def get_limiter_status() -> list[LimiterStatus]:
+    return [API_LIMITER.status(), DOWNLOAD_LIMITER.status()]
+
+
+def get_retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    # Retry-After is either a number of seconds or a http date
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    # Exponential backoff with jitter
+    delay = min(PAPERLESS_RETRY_MAX_DELAY, PAPERLESS_RETRY_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 class PaperlessClient:
     def __init__(self, base_url: str = PAPERLESS_URL, api_token: str = PAPERLESS_API_TOKEN):
         self.base_url = base_url
         self.api_token = api_token
 
     @asynccontextmanager
-    async def _get(self, url: str | pydantic.AnyHttpUrl) -> AsyncIterator[aiohttp.ClientResponse]:
-        async with aiohttp.ClientSession() as session:
-            if PAPERLESS_FORCE_SSL:
-                url = ensure_https(url)
-            
-            tries = 5
-            for _ in range(tries):
-                try:
-                    async with session.get(str(url), headers={'Authorization': f'Token {self.api_token}'}) as response:
-                        try:
-                            response.raise_for_status()
-                            yield response
-                            return
-                        except aiohttp.client_exceptions.ClientResponseError as e:
-                            if e.status == 500:
-                                # Paperless db connection can raise "sorry, too many clients already" error,
-                                # try again after delay.
-                                await asyncio.sleep(1)
-                except aiohttp.client_exceptions.ClientConnectorError as e:
-                    if 'host.docker.internal:8009' in str(e):
-                        raise IOError('When ssh-tunneling to paperless-ngx, ensure to use "ssh -L 0.0.0.0:8009:localhost:8009 <user@server>"') from e
-                    raise
+    async def _request(self, method: str, url: str | pydantic.AnyHttpUrl, limiter: AdaptiveLimiter, headers: Mapping[str, str] = {}, data: str | None = None, params: Mapping[str, str] | None = None) -> AsyncGenerator[aiohttp.ClientResponse, None]:
+        if PAPERLESS_FORCE_SSL:
+            url = ensure_https(url)
+        headers = {'Authorization': f'Token {self.api_token}', **headers}
+
+        async with get_session() as session:
+            for attempt in range(PAPERLESS_REQUEST_TRIES):
+                last_attempt = attempt == PAPERLESS_REQUEST_TRIES - 1
+                retry_after: str | None = None
+                async with limiter.slot():
+                    try:
+                        response = await session.request(method, str(url), headers=headers, data=data, params=params)
+                    except aiohttp.client_exceptions.ClientConnectorError as e:
+                        if 'host.docker.internal:8009' in str(e):
+                            raise IOError('When ssh-tunneling to paperless-ngx, ensure to use "ssh -L 0.0.0.0:8009:localhost:8009 <user@server>"') from e
+                        raise
+                    except aiohttp.client_exceptions.ServerDisconnectedError:
+                        if last_attempt:
+                            raise
+                        limiter.on_overload()
+                    else:
+                        async with response:
+                            if response.status not in RETRY_STATUSES or last_attempt:
+                                response.raise_for_status()
+                                limiter.on_success()
+                                yield response
+                                return
+                            limiter.on_overload()
+                            retry_after = response.headers.get('Retry-After')
+
+                # Wait outside of the slot so that it is available to other requests meanwhile
+                delay = get_retry_delay(attempt, retry_after)
+                log.info(f'Paperless request {method} {url} failed (attempt {attempt + 1}/{PAPERLESS_REQUEST_TRIES}), retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
 
+    @asynccontextmanager
+    async def _get(self, url: str | pydantic.AnyHttpUrl, limiter: AdaptiveLimiter = API_LIMITER) -> AsyncIterator[aiohttp.ClientResponse]:
+        async with self._request('GET', url, limiter) as response:
+            yield response
 
     @asynccontextmanager
     async def _put(self, url: str | pydantic.AnyHttpUrl, obj: pydantic.BaseModel) -> AsyncIterator[aiohttp.ClientResponse]:
-        async with aiohttp.ClientSession() as session:
-            if PAPERLESS_FORCE_SSL:
-                url = ensure_https(url)
-            async with session.put(str(url), headers={'Authorization': f'Token {self.api_token}', 'Content-type': 'application/json'}, data=obj.model_dump_json()) as response:
-                response.raise_for_status()
-                yield response
+        async with self._request('PUT', url, API_LIMITER, headers={'Content-type': 'application/json'}, data=obj.model_dump_json()) as response:
+            yield response
 
-    async def _iter_paginated_results[PaperlessDataT](self, url: str, result_type: Type[PaperlessDataT]) -> AsyncGenerator[PaperlessDataT, None]:
+    async def iter_paginated_results[PaperlessDataT](self, url: str, result_type: Type[PaperlessDataT]) -> AsyncGenerator[PaperlessDataT, None]:
         current_url: str | pydantic.AnyHttpUrl | None = url
         while current_url is not None:
             async with self._get(current_url) as response:
                 response.raise_for_status()
                 response_obj: PaperlessResponse[PaperlessDataT] = PaperlessResponse[result_type].model_validate(await response.json())
-                for obj in response_obj.results:
-                    yield obj
-                current_url = response_obj.next
+            # Yield outside of the request so that consumers making their own requests don't hold on to a limiter slot
+            for obj in response_obj.results:
+                yield obj
+            current_url = response_obj.next
     
     @asyncstdlib.cached_property
     async def tags_by_id(self) -> Mapping[int, PaperlessTag]:
-        res = { t.id: t async for t in self._iter_paginated_results(f'{self.base_url}/api/tags/?page_size=1000', PaperlessTag) }
+        res = { t.id: t async for t in self.iter_paginated_results(f'{self.base_url}/api/tags/?page_size=1000', PaperlessTag) }
         log.debug(f'Retrieved tags from Paperless')
         return res
 
@@ -294,7 +454,7 @@ class PaperlessClient:
 
     @asyncstdlib.cached_property
     async def custom_fields_by_id(self) -> Mapping[int, PaperlessCustomField]:
-        res = { f.id: f async for f in self._iter_paginated_results(f'{self.base_url}/api/custom_fields/?page_size=1000', PaperlessCustomField) }
+        res = { f.id: f async for f in self.iter_paginated_results(f'{self.base_url}/api/custom_fields/?page_size=1000', PaperlessCustomField) }
         log.debug(f'Retrieved custom fields from Paperless')
         return res
 
@@ -304,7 +464,7 @@ class PaperlessClient:
 
     @asyncstdlib.cached_property
     async def correspondents_by_id(self) -> Mapping[int, PaperlessCorrespondent]:
-        res = { c.id: c async for c in self._iter_paginated_results(f'{self.base_url}/api/correspondents/?page_size=1000', PaperlessCorrespondent) }
+        res = { c.id: c async for c in self.iter_paginated_results(f'{self.base_url}/api/correspondents/?page_size=1000', PaperlessCorrespondent) }
         log.debug(f'Retrieved correspondents from Paperless')
         return res
     
@@ -314,7 +474,7 @@ class PaperlessClient:
 
     @asyncstdlib.cached_property
     async def document_types_by_id(self) -> Mapping[int, PaperlessDocumentType]:
-        res = { t.id: t async for t in self._iter_paginated_results(f'{self.base_url}/api/document_types/?page_size=1000', PaperlessDocumentType) }
+        res = { t.id: t async for t in self.iter_paginated_results(f'{self.base_url}/api/document_types/?page_size=1000', PaperlessDocumentType) }
         log.debug(f'Retrieved document types from Paperless')
         return res
 
@@ -324,34 +484,40 @@ class PaperlessClient:
 
     @asyncstdlib.cached_property
     async def storage_paths_by_id(self) -> Mapping[int, PaperlessStoragePath]:
-        res = { p.id: p async for p in self._iter_paginated_results(f'{self.base_url}/api/storage_paths/?page_size=1000', PaperlessStoragePath) }
+        res = { p.id: p async for p in self.iter_paginated_results(f'{self.base_url}/api/storage_paths/?page_size=1000', PaperlessStoragePath) }
         log.debug(f'Retrieved storage paths from Paperless')
         return res
 
     async def get_document_by_id(self, document_id: int) -> PaperlessDocument:
         url = f'{self.base_url}/api/documents/{document_id}/'
         async with self._get(url) as response:
-            return PaperlessDocument.model_validate(await response.json())
+            document = PaperlessDocument.model_validate(await response.json())
+            DOCUMENT_INDEX.update(document.id, document.modified)
+            return document
 
-    async def put_document(self, document: PaperlessDocument):
-        async with self._put(f'{self.base_url}/api/documents/{document.id}/', document):
-            return
+    async def put_document(self, document: PaperlessDocument) -> PaperlessDocument:
+        # Returns the document as updated by paperless (eg. with new modification date)
+        async with self._put(f'{self.base_url}/api/documents/{document.id}/', document) as response:
+            updated_document = PaperlessDocument.model_validate(await response.json())
+            DOCUMENT_INDEX.update(updated_document.id, updated_document.modified)
+            return updated_document
 
 
     async def get_paperless_last_modified(self) -> tuple[int, pydantic.AwareDatetime] | tuple[None, None]:
-        async for doc in self._iter_paginated_results(f'{self.base_url}/api/documents/?ordering=-modified&fields=modified,id&page_size=1', PaperlessDocumentModificationDatetime):
+        async for doc in self.iter_paginated_results(f'{self.base_url}/api/documents/?ordering=-modified&fields=modified,id&page_size=1', PaperlessDocumentModificationDatetime):
             return (doc.id, doc.modified)
         return (None, None)
 
     
-    async def get_documents_with_tags_cache_key_func(self, required_tags: Collection[str], excluded_tags: Collection[str], correspondents: Collection[str] = [], document_types: Collection[str] = []) -> str:
-        args_key = await cache.base_cache_key_func(tuple(required_tags), tuple(excluded_tags), correspondents=tuple(correspondents), document_types=tuple(document_types))
+    async def get_documents_with_tags_cache_key_func(self, required_tags: Collection[str], excluded_tags: Collection[str], query: Mapping[str, str] = {}) -> str:
+        args_key = await cache.base_cache_key_func(tuple(required_tags), tuple(excluded_tags), query=tuple(sorted(query.items())))
         last_modified_id, last_modified_dt = await self.get_paperless_last_modified()
         return f'get_documents_with_tags-{args_key}-{last_modified_id}-{last_modified_dt}'
 
 
     @cache.AsyncIterableCache[PaperlessDocument]('paperless_data', cache_key_func=get_documents_with_tags_cache_key_func, expire=30 * 60)
-    async def get_documents_with_tags(self, required_tags: Collection[str], excluded_tags: Collection[str], correspondents: Collection[str] = [], document_types: Collection[str] = []) -> AsyncIterator[PaperlessDocument]:
+    async def get_documents_with_tags(self, required_tags: Collection[str], excluded_tags: Collection[str], query: Mapping[str, str] = {}) -> AsyncIterator[PaperlessDocument]:
+        # query holds additional document filter parameters (see Pattern.get_document_query())
         tags_by_name = await self.tags_by_name
         try:
             required_tag_ids = [str(tags_by_name[tag].id) for tag in required_tags]
@@ -360,33 +526,23 @@ class PaperlessClient:
             log.error(f'Tag "{e}" not found in paperless, no documents returned')
             return
 
-        url_params: dict[str, str] = {}
+        url_params: dict[str, str] = {**query}
         url_params['page_size'] = '50'
         if required_tag_ids:
-            url_params['tags__id__all'] = ",".join(required_tag_ids)
+            url_params['tags__id__all'] = ",".join(filter(None, [url_params.get('tags__id__all'), *required_tag_ids]))
         if excluded_tag_ids:
-            url_params['tags__id__none'] = ",".join(excluded_tag_ids)
-
-        if correspondents:
-            correspondents_by_name = await self.correspondents_by_name
-            correspondent_ids = [str(correspondents_by_name[c].id) for c in correspondents if c in correspondents_by_name]
-            url_params['correspondent__id__in'] = ",".join(correspondent_ids)
-        
-        if document_types:
-            document_types_by_name = await self.document_types_by_name
-            document_type_ids = [str(document_types_by_name[t].id) for t in document_types if t in document_types_by_name]
-            url_params['document_type__id__in'] = ",".join(document_type_ids)
+            url_params['tags__id__none'] = ",".join(filter(None, [url_params.get('tags__id__none'), *excluded_tag_ids]))
 
         query_string = urllib.parse.urlencode(url_params, safe=",")
 
         url = f'{self.base_url}/api/documents/?{query_string}'
-        async for d in self._iter_paginated_results(url, PaperlessDocument):
+        async for d in self.iter_paginated_results(url, PaperlessDocument):
             yield d
 
     @asynccontextmanager
     async def get_document_stream(self, document_id: int) -> AsyncIterator[aiohttp.StreamReader]:
         url = f'{self.base_url}/api/documents/{document_id}/download/'
-        async with self._get(url) as response:
+        async with self._get(url, DOWNLOAD_LIMITER) as response:
             yield response.content
 
     async def get_element_list(self, slug: str) -> list[PaperlessNamedElement]:
@@ -398,16 +554,81 @@ class PaperlessClient:
                 PaperlessAttribute(id=1, name='created', label='Created (Attribute)', data_type='date')
             ]
 
-        async for e in self._iter_paginated_results(f'{self.base_url}/api/{slug}/', PaperlessNamedElement):
+        async for e in self.iter_paginated_results(f'{self.base_url}/api/{slug}/', PaperlessNamedElement):
             res.append(e)
 
         return res
     
+    async def get_document_metadata(self, document_id: int) -> PaperlessDocumentMetadata:
+        async with self._get(f'{self.base_url}/api/documents/{document_id}/metadata/') as response:
+            return PaperlessDocumentMetadata.model_validate(await response.json())
+
     async def get_document_modified_date(self, document_id: int) -> pydantic.AwareDatetime:
         async with self._get(f'{self.base_url}/api/documents/{document_id}/?fields=modified,id') as response:
             validated_response = PaperlessDocumentModificationDatetime.model_validate(await response.json())
             return validated_response.modified
 
 
+class DocumentIndex:
+    """In-process index of the modification dates and file checksums of paperless documents.
+
+    Modification dates of all documents are retrieved with one paginated listing, after that only documents
+    modified since the last refresh are retrieved, at most once per refresh interval. Checksums are retrieved
+    per document and kept as long as its modification date does not change.
+    """
+
+    REFRESH_INTERVAL = float(os.environ.get('PAPERLESS_DOCUMENT_INDEX_REFRESH_INTERVAL', '30')) # seconds
+
+    def __init__(self):
+        self.modified: dict[int, datetime.datetime] = {}
+        self.checksums: dict[int, tuple[datetime.datetime, str]] = {} # id -> (modified, checksum)
+        self.latest_modified: datetime.datetime | None = None
+        self.last_refresh: float | None = None
+        self.lock = asyncio.Lock()
+
+    def update(self, document_id: int, modified: datetime.datetime):
+        # latest_modified is only advanced by refresh(), so that other documents modified in the meantime are still retrieved
+        self.modified[document_id] = modified
+
+    async def refresh(self, client: 'PaperlessClient'):
+        async with self.lock:
+            if self.last_refresh is not None and time.monotonic() - self.last_refresh < self.REFRESH_INTERVAL:
+                return
+
+            url_params = {'fields': 'id,modified', 'page_size': '1000', 'ordering': 'modified'}
+            if self.latest_modified is not None:
+                url_params['modified__gt'] = self.latest_modified.isoformat()
+
+            latest_modified = self.latest_modified
+            async for doc in client.iter_paginated_results(f'{client.base_url}/api/documents/?{urllib.parse.urlencode(url_params)}', PaperlessDocumentModificationDatetime):
+                self.modified[doc.id] = doc.modified
+                latest_modified = max(latest_modified or doc.modified, doc.modified)
+
+            self.latest_modified = latest_modified
+            self.last_refresh = time.monotonic()
+
+    async def get_modified(self, client: 'PaperlessClient', document_id: int) -> datetime.datetime:
+        await self.refresh(client)
+        if document_id not in self.modified:
+            # eg. added since the last refresh
+            self.modified[document_id] = await client.get_document_modified_date(document_id)
+        return self.modified[document_id]
+
+    async def get_checksum(self, client: 'PaperlessClient', document_id: int, modified: datetime.datetime | None = None) -> str:
+        if modified is None:
+            modified = await self.get_modified(client, document_id)
+
+        cached = self.checksums.get(document_id)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+
+        checksum = (await client.get_document_metadata(document_id)).checksum
+        self.checksums[document_id] = (modified, checksum)
+        return checksum
+
+
+DOCUMENT_INDEX = DocumentIndex()
+
+
 def get_paperless_url(document_id: int) -> str:
     return f'{PAPERLESS_URL}/documents/{document_id}/details'
@@ -1,5 +1,5 @@
 import pydantic
-from typing import Literal
+from typing import Callable, Iterator, Literal, Mapping, cast
 import abc
 import datetime
 import aiofiles
@@ -10,19 +10,271 @@ import urllib.parse
 import yaml
 import re
 import logging
+import weakref
+from collections import defaultdict
 
 import region
 import document
 import field
-from paperless import PaperlessClient, PaperlessDocument
+from paperless import PaperlessClient, PaperlessDocument, PaperlessNamedElement
 
 log = logging.getLogger('uvicorn')
 
-class Check(pydantic.BaseModel, abc.ABC):
+class CheckContext:
+    # Paperless names resolved to ids once per client, used by compiled checks. Only the elements used by checks are loaded.
+    # The context doesn't reference its client, so that contexts are collected along with their clients.
+    def __init__(self):
+        self.correspondent_ids: dict[str, set[int | None]] = {}
+        self.document_type_ids: dict[str, set[int | None]] = {}
+        self.storage_path_ids: dict[str, set[int | None]] = {}
+        self.tag_ids: dict[str, set[int | None]] = {}
+        self._loaded: set[type[Check]] = set()
+
+    @staticmethod
+    def _ids_by_name(elements: Mapping[int, PaperlessNamedElement]) -> dict[str, set[int | None]]:
+        ids_by_name: defaultdict[str, set[int | None]] = defaultdict(set)
+        ids_by_name[''].add(None) # Checks compare unset attributes as ''
+        for element_id, element in elements.items():
+            ids_by_name[element.name].add(element_id)
+        return ids_by_name
+
+    async def load(self, client: PaperlessClient, checks: list['AnyCheck']):
+        for check_type in set(type(c) for c in iter_checks(checks)) - self._loaded:
+            if check_type is CorrespondentCheck:
+                self.correspondent_ids = self._ids_by_name(await client.correspondents_by_id)
+            elif check_type is DocumentTypeCheck:
+                self.document_type_ids = self._ids_by_name(await client.document_types_by_id)
+            elif check_type is StoragePathCheck:
+                self.storage_path_ids = self._ids_by_name(await client.storage_paths_by_id)
+            elif check_type is TagCheck:
+                self.tag_ids = self._ids_by_name(await client.tags_by_id)
+            self._loaded.add(check_type)
+
+
+_check_contexts: weakref.WeakKeyDictionary[PaperlessClient, CheckContext] = weakref.WeakKeyDictionary()
+
+
+async def get_check_context(client: PaperlessClient, checks: list['AnyCheck']) -> CheckContext:
+    if (context := _check_contexts.get(client)) is None:
+        context = CheckContext()
+        _check_contexts[client] = context
+    await context.load(client, checks)
+    return context
+
+
+def iter_checks(checks: list['AnyCheck']) -> Iterator['AnyCheck']:
+    # All checks in the given check trees
+    for check in checks:
+        yield check
+        if isinstance(check, (AndCheck, OrCheck)):
+            yield from iter_checks(check.checks)
+        elif isinstance(check, NotCheck):
+            yield from iter_checks([check.check])
+
+
+# Estimated cost of compiled checks, used to order the children of and/or checks so that cheap (and mostly selective)
+# id comparisons short-circuit before regexes and checks that may need the parsed document.
+COST_ID = 1
+COST_REGEX = 2
+COST_DOCUMENT = 10
+
+
+class CompiledCheck(abc.ABC):
+    # Check compiled to a synchronous predicate over paperless metadata. decide() returns None if the parsed
+    # document is needed, which resolve() then uses (with the client the checks were compiled for).
+    cost: int
+
     @abc.abstractmethod
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        raise NotImplementedError()
+
+    async def resolve(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        res = self.decide(paperless_doc)
+        return res if res is not None else await self.resolve_with_document(doc, paperless_doc, client)
+
+    async def resolve_with_document(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        raise NotImplementedError()
+
+
+class CompiledPredicate(CompiledCheck):
+    def __init__(self, predicate: Callable[[PaperlessDocument], bool], cost: int):
+        self.predicate = predicate
+        self.cost = cost
+
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        return self.predicate(paperless_doc)
+
+
+class CompiledDocumentCheck(CompiledCheck):
+    # Leaf needing the parsed document unless decide_from_metadata can decide
+    def __init__(self, check: 'Check', decide_from_metadata: Callable[[PaperlessDocument], bool | None] | None = None):
+        self.check = check
+        self.decide_from_metadata = decide_from_metadata
+        self.cost = COST_DOCUMENT
+
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        return self.decide_from_metadata(paperless_doc) if self.decide_from_metadata else None
+
+    async def resolve_with_document(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        return await self.check.matches(doc, paperless_doc, client)
+
+
+class CompiledAnd(CompiledCheck):
+    def __init__(self, children: list[CompiledCheck]):
+        self.children = sorted(children, key=lambda c: c.cost)
+        self.cost = sum(c.cost for c in children)
+
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        res: bool | None = True
+        for child in self.children:
+            child_res = child.decide(paperless_doc)
+            if child_res is False:
+                return False
+            if child_res is None:
+                res = None
+        return res
+
+    async def resolve_with_document(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        for child in self.children:
+            if not await child.resolve(doc, paperless_doc, client):
+                return False
+        return True
+
+
+class CompiledOr(CompiledCheck):
+    def __init__(self, children: list[CompiledCheck]):
+        self.children = sorted(children, key=lambda c: c.cost)
+        self.cost = sum(c.cost for c in children)
+
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        res: bool | None = False
+        for child in self.children:
+            child_res = child.decide(paperless_doc)
+            if child_res is True:
+                return True
+            if child_res is None:
+                res = None
+        return res
+
+    async def resolve_with_document(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        for child in self.children:
+            if await child.resolve(doc, paperless_doc, client):
+                return True
+        return False
+
+
+class CompiledNot(CompiledCheck):
+    def __init__(self, child: CompiledCheck):
+        self.child = child
+        self.cost = child.cost
+
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        res = self.child.decide(paperless_doc)
+        return None if res is None else not res
+
+    async def resolve_with_document(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        return not await self.child.resolve(doc, paperless_doc, client)
+
+
+class CompiledError(CompiledCheck):
+    # Check that failed to compile (eg. invalid regex), the error is raised when it is evaluated
+    def __init__(self, error: Exception):
+        self.error = error
+        self.cost = 0
+
+    def decide(self, paperless_doc: PaperlessDocument) -> bool | None:
+        raise self.error
+
+
+# Paperless document filter parameters, id lists as sets (an empty set for an __in parameter matches no documents)
+QueryParams = dict[str, frozenset[int] | str]
+
+
+def get_element_query(param: str, ids: set[int | None]) -> tuple[QueryParams, bool] | None:
+    if ids == {None}:
+        return {f'{param}__isnull': '1'}, True
+    if None in ids:
+        return None
+    return {f'{param}__id__in': frozenset(cast(set[int], ids))}, True
+
+
+def get_literal_prefix(regex: str) -> str:
+    # Literal text that all matches of regex (with re.match) start with, eg. 'Invoice ' for r'Invoice (\d+)'
+    if '|' in regex:
+        return ''
+    prefix: list[str] = []
+    i = 0
+    while i < len(regex):
+        if regex[i] == '\\' and i + 1 < len(regex) and not regex[i + 1].isalnum():
+            char, step = regex[i + 1], 2
+        elif regex[i].isalnum() or regex[i] in ' _-:,/#':
+            char, step = regex[i], 1
+        else:
+            break
+        quantifier = regex[i + step:i + step + 1]
+        if quantifier and quantifier in '?*{':
+            break
+        prefix.append(char)
+        if quantifier == '+':
+            break
+        i += step
+    return ''.join(prefix)
+
+
+def merge_query_params(params: QueryParams, other: QueryParams) -> QueryParams | None:
+    # Parameters selecting the documents selected by both, None if they conflict (eg. two different title prefixes)
+    merged = {**params}
+    for key, value in other.items():
+        existing = merged.get(key)
+        if existing is None:
+            merged[key] = value
+        elif isinstance(existing, frozenset) and isinstance(value, frozenset):
+            merged[key] = existing & value if key.endswith('__in') else existing | value
+        elif key == 'created__date__lt':
+            merged[key] = min(cast(str, existing), cast(str, value))
+        elif key == 'created__date__gt':
+            merged[key] = max(cast(str, existing), cast(str, value))
+        elif existing != value:
+            return None
+    return merged
+
+
+def merge_queries(queries: list[tuple[QueryParams, bool] | None]) -> tuple[QueryParams, bool]:
+    # Conjunction of queries. Queries that are not expressible or conflict with the others are left out, making the
+    # result inexact.
+    params: QueryParams = {}
+    exact = True
+    for query in queries:
+        merged = merge_query_params(params, query[0]) if query is not None else None
+        if merged is not None:
+            params = merged
+        exact = exact and merged is not None and cast(tuple[QueryParams, bool], query)[1]
+    return params, exact
+
+
+class Check(pydantic.BaseModel, abc.ABC):
     async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
+        return await self.compile(await get_check_context(client, [cast(AnyCheck, self)])).resolve(doc, paperless_doc, client)
+
+    @abc.abstractmethod
+    def compile(self, context: CheckContext) -> CompiledCheck:
         raise NotImplementedError()
 
+    def needs_document(self) -> bool:
+        # Whether the parsed document may be needed to decide the check
+        return True
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        # Paperless document filter parameters selecting (at least) the documents the check can match, and whether
+        # they select exactly those (so that the check need not be evaluated locally). None if not expressible.
+        return None
+
+
+class MetadataCheck(Check):
+    # Check deciding on paperless metadata only
+    def needs_document(self) -> bool:
+        return False
+
 
 class NumPagesCheck(Check):
     type: Literal['num_pages']
@@ -31,120 +283,198 @@ class NumPagesCheck(Check):
     async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
         return len(doc.pages) == self.num_pages
 
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        # Decided using the page count from paperless if available
+        num_pages = self.num_pages
+        return CompiledDocumentCheck(self, lambda d: None if d.page_count is None else d.page_count == num_pages)
+
 
 class RegionCheck(region.Region, Check):
     type: Literal['region']
 
     async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        for page in doc.pages:
+        # Pages are parsed as they are reached, so parsing stops at the first matching page
+        async for page in doc.iter_pages():
             region_result = self.evaluate_on_page(page) # TODO correct to match on any page?
             if region_result.group_values is not None:
                 return True
         return False
 
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        return CompiledDocumentCheck(self)
+
 
-class TitleRegexCheck(Check):
+class TitleRegexCheck(MetadataCheck):
     type: Literal['title']
     regex: str
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        return re.match(self.regex, doc.title) is not None
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        pattern = re.compile(self.regex)
+        return CompiledPredicate(lambda d: pattern.match(d.title) is not None, COST_REGEX)
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        # Paperless has no regex filter, a literal prefix narrows the documents down (case insensitively)
+        if prefix := get_literal_prefix(self.regex):
+            return {'title__istartswith': prefix}, False
+        return None
 
 
-class CorrespondentCheck(Check):
+class CorrespondentCheck(MetadataCheck):
     type: Literal['correspondent']
     name: str
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        correspondents = await client.correspondents_by_id
-        c_name = correspondents[paperless_doc.correspondent].name if paperless_doc.correspondent != None else ''
-        return c_name == self.name
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        ids = context.correspondent_ids.get(self.name, set())
+        return CompiledPredicate(lambda d: d.correspondent in ids, COST_ID)
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        return get_element_query('correspondent', context.correspondent_ids.get(self.name, set()))
 
 
-class DocumentTypeCheck(Check):
+class DocumentTypeCheck(MetadataCheck):
     type: Literal['document_type']
     name: str
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        doc_types = await client.document_types_by_id
-        d_name = doc_types[paperless_doc.document_type].name if paperless_doc.document_type != None else ''
-        return d_name == self.name
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        ids = context.document_type_ids.get(self.name, set())
+        return CompiledPredicate(lambda d: d.document_type in ids, COST_ID)
 
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        return get_element_query('document_type', context.document_type_ids.get(self.name, set()))
 
-class StoragePathCheck(Check):
+
+class StoragePathCheck(MetadataCheck):
     type: Literal['storage_path']
     name: str
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        storage_paths = await client.storage_paths_by_id
-        s_name = storage_paths[paperless_doc.storage_path].name if paperless_doc.storage_path != None else ''
-        return s_name == self.name
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        ids = context.storage_path_ids.get(self.name, set())
+        return CompiledPredicate(lambda d: d.storage_path in ids, COST_ID)
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        return get_element_query('storage_path', context.storage_path_ids.get(self.name, set()))
 
 
-class TagCheck(Check):
+class TagCheck(MetadataCheck):
     type: Literal['tags']
     includes: list[str] = []
     excludes: list[str] = []
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        tags = await client.tags_by_id
-        document_tags = set([tags[t_id].name for t_id in paperless_doc.tags])
-        
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        # One set of ids per included tag name (a document needs one of each), one set for all excluded names
+        include_ids = [context.tag_ids.get(t, set()) - {None} for t in self.includes]
+        exclude_ids = set[int | None]().union(*(context.tag_ids.get(t, set()) for t in self.excludes)) - {None}
+        def predicate(d: PaperlessDocument) -> bool:
+            document_tags = set(d.tags)
+            return all(not ids.isdisjoint(document_tags) for ids in include_ids) and exclude_ids.isdisjoint(document_tags)
+        return CompiledPredicate(predicate, COST_ID)
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        params: QueryParams = {}
+        exact = True
+        include_ids: set[int] = set()
         for t in self.includes:
-            if t not in document_tags:
-                return False
-        
-        for t in self.excludes:
-            if t in document_tags:
-                return False
-
-        return True
-
-
-class DateCreatedCheck(Check):
+            ids = context.tag_ids.get(t, set()) - {None}
+            if not ids:
+                return {'id__in': frozenset()}, True # No such tag
+            if len(ids) == 1:
+                include_ids |= cast(set[int], ids)
+            else:
+                exact = False # Several tags with the same name, checked locally
+        exclude_ids = set[int | None]().union(*(context.tag_ids.get(t, set()) for t in self.excludes)) - {None}
+        if include_ids:
+            params['tags__id__all'] = frozenset(include_ids)
+        if exclude_ids:
+            params['tags__id__none'] = frozenset(cast(set[int], exclude_ids))
+        return params, exact
+
+
+class DateCreatedCheck(MetadataCheck):
     type: Literal['date_created']
     before: datetime.date | None = None
     after: datetime.date | None = None
     year: int | None = None
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        if self.before is not None and doc.date_created >= self.before:
-            return False
-        if self.after is not None and doc.date_created <= self.after:
-            return False
-        if self.year and doc.date_created.year != self.year:
-            return False
-        return True
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        before, after, year = self.before, self.after, self.year
+        def predicate(d: PaperlessDocument) -> bool:
+            if before is not None and d.created >= before:
+                return False
+            if after is not None and d.created <= after:
+                return False
+            if year and d.created.year != year:
+                return False
+            return True
+        return CompiledPredicate(predicate, COST_ID)
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        params: QueryParams = {}
+        if self.before is not None:
+            params['created__date__lt'] = self.before.isoformat()
+        if self.after is not None:
+            params['created__date__gt'] = self.after.isoformat()
+        if self.year:
+            params['created__year'] = str(self.year)
+        return params, True
 
 
 class AndCheck(Check):
     type: Literal['and']
     checks: list['AnyCheck']
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        for check in self.checks:
-            if not await check.matches(doc, paperless_doc, client):
-                return False
-        return True
+    def needs_document(self) -> bool:
+        return any(c.needs_document() for c in self.checks)
+
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        return CompiledAnd([c.compile(context) for c in self.checks])
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        return merge_queries([c.get_query(context) for c in self.checks])
     
 
 class OrCheck(Check):
     type: Literal['or']
     checks: list['AnyCheck']
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        for check in self.checks:
-            if await check.matches(doc, paperless_doc, client):
-                return True
-        return False
+    def needs_document(self) -> bool:
+        return any(c.needs_document() for c in self.checks)
+
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        return CompiledOr([c.compile(context) for c in self.checks])
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        # An or over checks of the same kind of element (eg. several correspondents) becomes one id list
+        queries = [c.get_query(context) for c in self.checks]
+        if not queries or any(q is None or not q[1] or len(q[0]) != 1 for q in queries):
+            return None
+        keys = set(key for q in queries for key in cast(tuple[QueryParams, bool], q)[0])
+        key = keys.pop()
+        if keys or not key.endswith('__id__in'):
+            return None
+        return {key: frozenset().union(*(cast(frozenset[int], cast(tuple[QueryParams, bool], q)[0][key]) for q in queries))}, True
 
 
 class NotCheck(Check):
     type: Literal['not']
     check: 'AnyCheck'
 
-    async def matches(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        return not await self.check.matches(doc, paperless_doc, client)
+    def needs_document(self) -> bool:
+        return self.check.needs_document()
+
+    def compile(self, context: CheckContext) -> CompiledCheck:
+        return CompiledNot(self.check.compile(context))
+
+    def get_query(self, context: CheckContext) -> tuple[QueryParams, bool] | None:
+        # Only the negation of a single id list (eg. not this correspondent, not this tag) is expressible
+        query = self.check.get_query(context)
+        if query is None or not query[1] or len(query[0]) != 1:
+            return None
+        key, value = next(iter(query[0].items()))
+        if key.endswith('__id__in') and key != 'id__in':
+            return {key.removesuffix('__in') + '__none': value}, True
+        if key == 'tags__id__all' and isinstance(value, frozenset) and len(value) == 1:
+            return {'tags__id__none': value}, True
+        return None
 
 
 AnyCheck = NumPagesCheck | RegionCheck | TitleRegexCheck | CorrespondentCheck | DocumentTypeCheck | StoragePathCheck | TagCheck | DateCreatedCheck | AndCheck | OrCheck | NotCheck
@@ -173,71 +503,175 @@ class Pattern(pydantic.BaseModel):
     regions: list[region.Region]
     fields: list[field.Field]
 
+    _compiled_checks: tuple[CheckContext, list[CompiledCheck]] | None = pydantic.PrivateAttr(None)
+
     async def checks_match(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool:
-        for check in self.checks:
+        check_results = await self.get_check_results(doc, paperless_doc, client, stop_early=True)
+        return all(r.passed for r in check_results)
+
+    async def get_compiled_checks(self, client: PaperlessClient) -> list[CompiledCheck]:
+        # Compiled once per client (whose names and ids they use)
+        context = await get_check_context(client, self.checks)
+        if self._compiled_checks is None or self._compiled_checks[0] is not context:
+            compiled_checks: list[CompiledCheck] = []
+            for check in self.checks:
+                try:
+                    compiled_checks.append(check.compile(context))
+                except Exception as e:
+                    compiled_checks.append(CompiledError(e))
+            self._compiled_checks = (context, compiled_checks)
+        return self._compiled_checks[1]
+
+    async def match_metadata(self, paperless_doc: PaperlessDocument, client: PaperlessClient) -> bool | None:
+        # False if the checks fail on paperless metadata alone, in which case the document need not be parsed.
+        # None if the parsed document is needed to decide.
+        res: bool | None = True
+        for compiled_check in sorted(await self.get_compiled_checks(client), key=lambda c: c.cost):
             try:
-                if not await check.matches(doc, paperless_doc, client):
-                    return False
+                check_res = compiled_check.decide(paperless_doc)
             except Exception:
-                log.exception(f'Exception while running check {check}')
+                check_res = None # Left to get_check_results(), which reports the error
+            if check_res is False:
                 return False
+            if check_res is None:
+                res = None
+        return res
 
-        return True
-
-    async def get_check_results(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient) -> list[CheckResult]:
-        res: list[CheckResult] = []
-        for check in self.checks:
+    async def get_check_results(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient, stop_early: bool = False) -> list[CheckResult]:
+        # Cheaper checks are run first. With stop_early, the checks following a failed check are not run (and reported as not passed).
+        compiled_checks = await self.get_compiled_checks(client)
+        res: list[CheckResult | None] = [None] * len(self.checks)
+        failed = False
+        for index in sorted(range(len(self.checks)), key=lambda i: compiled_checks[i].cost):
+            if stop_early and failed:
+                res[index] = CheckResult(passed=False, error=None)
+                continue
             try:
-                passed = await check.matches(doc, paperless_doc, client)
+                passed = await compiled_checks[index].resolve(doc, paperless_doc, client)
                 error = None
             except Exception as e:
+                if stop_early:
+                    log.exception(f'Exception while running check {self.checks[index]}')
                 passed = False
                 error = str(e)
-            res.append(CheckResult(passed=passed, error=error))
+            res[index] = CheckResult(passed=passed, error=error)
+            failed = failed or not passed
 
-        return res
+        return cast(list[CheckResult], res)
 
-    async def evaluate(self, document_id: int, preprocess: PreprocessType, client: PaperlessClient) -> PatternEvaluationResult:
-        doc = await document.get_parsed_document(document_id, preprocess, client=client)
+    async def evaluate(self, document_id: int, preprocess: PreprocessType, client: PaperlessClient, stop_early: bool = False) -> PatternEvaluationResult:
         paperless_doc = await client.get_document_by_id(document_id)
+        async with document.open_parsed_document(document_id, preprocess, client=client, paperless_doc=paperless_doc) as doc:
+            _, result = await self.match_and_evaluate(doc, paperless_doc, client, stop_early=stop_early)
+            return result
 
-        check_results = await self.get_check_results(doc=doc, paperless_doc=paperless_doc, client=client)
+    async def match_and_evaluate(self, doc: document.Document, paperless_doc: PaperlessDocument, client: PaperlessClient, stop_early: bool = False) -> tuple[bool, PatternEvaluationResult]:
+        # Runs the checks once and, if they all pass, evaluates regions and fields on the same document.
+        # With stop_early, checks stop at the first failure and only the region results that are retained are
+        # guaranteed to be evaluated (see Document.evaluate_regions()).
+        check_results = await self.get_check_results(doc, paperless_doc, client, stop_early=stop_early)
 
         # If any check failed, return result without region or field data
         if any(r.passed == False for r in check_results):
             region_results = [[region.RegionResult.no_match('')] * len(doc.pages)] * len(self.regions)
             field_results = [None] * len(self.fields)
-            return PatternEvaluationResult(checks=check_results, regions=region_results, fields=field_results)
+            return False, PatternEvaluationResult(checks=check_results, regions=region_results, fields=field_results)
 
-        region_results = doc.evaluate_regions(self.regions)
+        region_results = await doc.evaluate_regions(self.regions, stop_early=stop_early)
         region_values = region.RegionResult.results_to_values(region_results)
 
-        field_results: list[field.FieldResult|None] = []
-        for f in self.fields:
-            field_result = await f.get_result(client, region_values)
-            field_results.append(field_result)
-
-        return PatternEvaluationResult(checks=check_results, regions=region_results, fields=field_results)
+        field_results: list[field.FieldResult|None] = [*await field.get_field_results(self.fields, client, region_values)]
 
-    def get_required_correspondents_and_document_types(self) -> tuple[list[str], list[str]]:
-        # Most patterns have simple checks (eg. one document type and one correspondent).
-        # This method extracts these checks from the pattern so that they can be used
-        # as url parameters when querying paperless, reducing the number of documents that
-        # need to be checked when getting the list of documents matching a pattern.
-
-        correspondents: list[str] = []
-        document_types: list[str] = []
+        return True, PatternEvaluationResult(checks=check_results, regions=region_results, fields=field_results)
 
+    async def get_document_query(self, client: PaperlessClient) -> tuple[dict[str, str], list['AnyCheck']] | None:
+        # Paperless query parameters selecting the documents the pattern's checks can match, and the (top-level) checks
+        # that still need to be evaluated locally. None if no document can match (eg. a correspondent that doesn't exist).
+        context = await get_check_context(client, self.checks)
+        checks: list[AnyCheck] = []
         for check in self.checks:
-            # simple non-recursive loop to find
-
-            if isinstance(check, CorrespondentCheck):
-                correspondents.append(check.name)
+            checks.extend(check.checks if isinstance(check, AndCheck) else [check])
+
+        params: QueryParams = {}
+        residual_checks: list[AnyCheck] = []
+        for check in checks:
+            query = check.get_query(context)
+            merged = merge_query_params(params, query[0]) if query is not None else None
+            if merged is not None:
+                params = merged
+            if merged is None or not cast(tuple[QueryParams, bool], query)[1]:
+                residual_checks.append(check)
+
+        if any(key.endswith('__in') and not value for key, value in params.items()):
+            return None
+        return { key: ','.join(str(i) for i in sorted(value)) if isinstance(value, frozenset) else value for key, value in params.items() if value }, residual_checks
+
+    def with_checks(self, checks: list['AnyCheck']) -> 'Pattern':
+        return Pattern(enabled=self.enabled, name=self.name, preprocess=self.preprocess, checks=checks, regions=self.regions, fields=self.fields)
+
+    def get_index_key(self) -> tuple[str, str] | None:
+        # The most selective (kind, name) pair that documents must have for the pattern to match, taken from the
+        # top-level (and nested and) checks. None if the checks don't require any.
+        requirements: dict[str, str] = {}
+        checks: list[AnyCheck] = [*self.checks]
+        while checks:
+            check = checks.pop(0)
+            if isinstance(check, AndCheck):
+                checks.extend(check.checks)
+            elif isinstance(check, CorrespondentCheck):
+                requirements.setdefault('correspondent', check.name)
+            elif isinstance(check, DocumentTypeCheck):
+                requirements.setdefault('document_type', check.name)
+            elif isinstance(check, StoragePathCheck):
+                requirements.setdefault('storage_path', check.name)
+            elif isinstance(check, TagCheck) and check.includes:
+                requirements.setdefault('tag', check.includes[0])
+
+        for kind in ('correspondent', 'document_type', 'storage_path', 'tag'):
+            if kind in requirements:
+                return (kind, requirements[kind])
+        return None
+
+
+class PatternIndex:
+    # Finds the patterns that can match a document by the correspondent, document type, storage path or tag they require,
+    # so that not every pattern needs to be tried on every document. Patterns without such requirements are always candidates.
+    def __init__(self, patterns: list[Pattern]):
+        self.patterns = patterns
+        self._order = { id(p): i for i, p in enumerate(patterns) }
+        self._unconstrained: list[Pattern] = []
+        self._by_key: defaultdict[tuple[str, str], list[Pattern]] = defaultdict(list)
+        for p in patterns:
+            if not p.enabled:
+                continue
+            key = p.get_index_key()
+            if key is None:
+                self._unconstrained.append(p)
+            else:
+                self._by_key[key].append(p)
+
+    async def get_candidates(self, paperless_doc: PaperlessDocument, client: PaperlessClient) -> list[Pattern]:
+        # Enabled patterns that may match paperless_doc, in the original order. Names of unset attributes are '' as in the checks.
+        correspondents = await client.correspondents_by_id
+        document_types = await client.document_types_by_id
+        storage_paths = await client.storage_paths_by_id
+        tags = await client.tags_by_id
 
-            if isinstance(check, DocumentTypeCheck):
-                document_types.append(check.name)
+        try:
+            keys = [
+                ('correspondent', correspondents[paperless_doc.correspondent].name if paperless_doc.correspondent is not None else ''),
+                ('document_type', document_types[paperless_doc.document_type].name if paperless_doc.document_type is not None else ''),
+                ('storage_path', storage_paths[paperless_doc.storage_path].name if paperless_doc.storage_path is not None else ''),
+                *(('tag', tags[t_id].name) for t_id in paperless_doc.tags),
+            ]
+        except KeyError:
+            # Unknown to the client (eg. created since it was instantiated), leave it to the checks
+            return [p for p in self.patterns if p.enabled]
 
-        return (correspondents, document_types)
+        candidates = [*self._unconstrained]
+        for key in keys:
+            candidates.extend(self._by_key.get(key, []))
+        return sorted(candidates, key=lambda p: self._order[id(p)])
 
 
 class PatternListEntry(pydantic.BaseModel):
@@ -278,6 +712,22 @@ async def list_patterns() -> list[PatternListEntry]:
     return sorted(res, key=lambda e: e.name)
 
 
+_pattern_index: PatternIndex | None = None
+_pattern_index_key: list[tuple[str, int]] = []
+
+
+async def get_pattern_index() -> PatternIndex:
+    # Index of all patterns, rebuilt whenever a pattern file has been added, changed or removed
+    global _pattern_index, _pattern_index_key
+    key = [(e.name, (await aiofiles.os.stat(CONFIG_PATH / escape_name(e.name))).st_mtime_ns) for e in await list_patterns()]
+    if _pattern_index is None or key != _pattern_index_key:
+        patterns = [await get_pattern(name) for name, _ in key]
+        _pattern_index = PatternIndex(patterns)
+        _pattern_index_key = key
+        log.debug(f'Built index of {len(patterns)} patterns')
+    return _pattern_index
+
+
 async def create_pattern(name: str) -> Pattern:
     pattern = Pattern(name=name, enabled=False, checks=[], regions=[], fields=[])
     async with async_open(name_to_path(name), 'x') as f:
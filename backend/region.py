@@ -1,6 +1,8 @@
 import pydantic
 import typing
 import re
+import os
+import functools
 from simple_expr import simple_expr_to_regex, ExpressionError
 
 if typing.TYPE_CHECKING:
@@ -47,54 +49,75 @@ class RegionBase(pydantic.BaseModel):
         return hash((Region, self.x, self.y, self.x2, self. y2))
 
 
+# Compiled regex of a region expression, or the error message if the expression is invalid
+CompiledExpression = tuple[re.Pattern[str], None] | tuple[None, str]
+
+REGION_EXPRESSION_CACHE_SIZE = int(os.environ.get('REGION_EXPRESSION_CACHE_SIZE', '4096'))
+
+
+@functools.lru_cache(maxsize=REGION_EXPRESSION_CACHE_SIZE)
+def compile_expression(kind: typing.Literal['simple', 'regex'], expr: str) -> CompiledExpression:
+    # Process-wide cache shared by all regions (including region checks), see compile_expression.cache_info() for hits/misses.
+    # Unlike the cache of the re module, it is large enough for all expressions of all patterns.
+    options = re.DOTALL | re.MULTILINE
+    if kind == 'simple':
+        options |= re.IGNORECASE
+        try:
+            expr = simple_expr_to_regex(expr)
+        except ExpressionError as e:
+            return None, str(e)
+
+    try:
+        return re.compile(expr, options), None
+    except re.error as e:
+        return None, e.msg
+
+
 class Region(RegionBase):
     page: int | typing.Literal['first_match', 'last_match'] = 'last_match'
     kind: typing.Literal['simple', 'regex']
     simple_expr: str | None = None
     regex_expr: str | None = None
 
+    _matcher: tuple[tuple[str, str], CompiledExpression] | None = pydantic.PrivateAttr(None)
+
     def evaluate_on_page(self, page: 'Page') -> 'RegionResult':
         text = page.get_region_text(self)
         return self.evaluate_on_text(page.page_nr, text)
 
-    def evaluate_on_text(self, page_nr: int, text: str) -> 'RegionResult':
+    def get_matcher(self) -> 'CompiledExpression | None':
+        # Compiled on first use and kept until the expression changes, None if the region has no expression
+        expr = self.regex_expr if self.kind == 'regex' else self.simple_expr
+        if not expr:
+            return None
 
-        regex = None
-        if self.kind == 'regex':
-            if not self.regex_expr:
-                return RegionResult.no_match(text)
-            regex = self.regex_expr
+        key = (self.kind, expr)
+        if self._matcher is None or self._matcher[0] != key:
+            self._matcher = (key, compile_expression(self.kind, expr))
+        return self._matcher[1]
 
-        elif self.kind == 'simple':
-            if not self.simple_expr:
-                return RegionResult.no_match(text)
-            try:
-                regex = simple_expr_to_regex(self.simple_expr)
-            except ExpressionError as e:
-                return RegionResult(text=text, error=str(e), group_values=None, group_positions=None, is_retained=False)
+    def evaluate_on_text(self, page_nr: int, text: str) -> 'RegionResult':
+        matcher = self.get_matcher()
+        if matcher is None:
+            return RegionResult.no_match(text)
 
+        regex, error = matcher
         if regex is None:
-                return RegionResult.no_match(text)
+            return RegionResult(text=text, error=error, group_values=None, group_positions=None, is_retained=False)
 
-        try:
-            options = re.DOTALL | re.MULTILINE
-            if self.kind == 'simple':
-                options |= re.IGNORECASE
-            if match := re.search(regex, text, options):
-
-                group_values: dict[str, str] = {}
-                group_positions: list[tuple[int, int]] = []
-                for name, index in match.re.groupindex.items():
-                    start, end = match.span(index)
-                    if start != -1:  # group actually matched
-                        group_values[name] = match.group(name)
-                        group_positions.append((start, end))
-
-                return RegionResult(text=text, error=None, group_values=group_values, group_positions=group_positions, is_retained=False)
-            else:
-                return RegionResult.no_match(text=text)
-        except re.error as e:
-            return RegionResult(text=text, error=e.msg, group_values=None, group_positions=None, is_retained=False)
+        if match := regex.search(text):
+
+            group_values: dict[str, str] = {}
+            group_positions: list[tuple[int, int]] = []
+            for name, index in match.re.groupindex.items():
+                start, end = match.span(index)
+                if start != -1:  # group actually matched
+                    group_values[name] = match.group(name)
+                    group_positions.append((start, end))
+
+            return RegionResult(text=text, error=None, group_values=group_values, group_positions=group_positions, is_retained=False)
+        else:
+            return RegionResult.no_match(text=text)
 
     def get_selected_result(self, results: list['RegionResult']) -> 'RegionResult | None':
         selected_page_result: RegionResult | None = None
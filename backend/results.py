@@ -43,6 +43,13 @@ class ProcessingResults(pydantic.BaseModel):
     def register_unmatched(self, document_id: int, document_title: str):
         self.unmatched.append(ProcessedDocument(id=document_id, title=document_title))
 
+    def merge(self, other: 'ProcessingResults'):
+        self.errors.extend(other.errors)
+        for document_id, pattern_names in other.matched_patterns.items():
+            self.matched_patterns[document_id].extend(pattern_names)
+        self.matched_document_titles.update(other.matched_document_titles)
+        self.unmatched.extend(other.unmatched)
+
     def save(self):
         try:
             tmp_file = (RESULTS_FILE_PATH.parent / 'results.json.tmp').resolve()
@@ -9,9 +9,29 @@ TODO: anonymized Pattern
 '''
 
 
-from document import Document
-from pattern import Pattern
+from document import Document, DocumentParser, DocumentParseStatus, LazyPages, Page, TextRun, TextRunIndex, TextRuns, is_partially_parsed_document
+from region import Region, RegionBase, compile_expression
+from pattern import Pattern, PatternIndex, get_check_context
+from field import Field, compile_template, render_fields
+import cache
+import paperless
+import matching
+import ledger
+import utils
+import datetime
+import diskcache
+import gc
+import pathlib
+import tempfile
+import urllib.parse
+import weakref
 import yaml
+import asyncstdlib
+import asyncio
+import aiohttp
+import aiohttp.test_utils
+import aiohttp.web
+from typing import Any, AsyncGenerator, Iterable, Mapping, cast
 
 
 class TestRegionResultText(unittest.TestCase):
@@ -31,5 +51,479 @@ class TestRegionResultText(unittest.TestCase):
         text = self.page.get_region_text(self.region)
         self.assertIn('test case', text)
 
+
+class TestDocumentBinaryFormat(unittest.TestCase):
+
+    def setUp(self) -> None:
+        runs = [TextRun.model_validate({ 'text': 'test', 'x': 10.0, 'y': 20.0, 'x2': 30.0, 'y2': 28.5 }), TextRun.model_validate({ 'text': 'case', 'x': 32.0, 'y': 20.0, 'x2': 50.25, 'y2': 28.5 })]
+        page = Page(page_nr=0, width=595.0, height=842.0, text_runs=TextRuns.from_runs(runs))
+        now = datetime.datetime(2024, 1, 1, 12, 0).astimezone()
+        self.document = Document.model_validate({ 'id': 1, 'title': 'Test', 'correspondent': None, 'document_type': 'Bill', 'paperless_url': 'http://localhost/documents/1/details',
+                                                  'datetime_added': now, 'date_created': now.date(), 'pages': [page, page.model_copy(update={'page_nr': 1})],
+                                                  'parse_status': DocumentParseStatus(datetime_parsed=now, error=None) })
+
+    def test_round_trip(self):
+        loaded = Document.from_bytes(self.document.to_bytes())
+        self.assertEqual(loaded.model_dump(), self.document.model_dump())
+
+    def test_json_shape(self):
+        page = self.document.model_dump(mode='json')['pages'][0]
+        self.assertEqual(page['text_runs'][1], {'x': 32.0, 'y': 20.0, 'x2': 50.25, 'y2': 28.5, 'text': 'case'})
+        self.assertEqual(Page.model_validate_json(Page.model_validate(page).model_dump_json()), self.document.pages[0])
+
+    def test_rejects_other_data(self):
+        yaml_data = yaml.dump(self.document.model_dump(mode='json'), Dumper=yaml.CDumper).encode('utf-8')
+        with self.assertRaises(cache.CacheFormatError):
+            Document.from_bytes(yaml_data)
+
+    def test_partially_parsed_flag(self):
+        self.assertFalse(is_partially_parsed_document(self.document.to_bytes()))
+        pages = LazyPages(2, None, unparsed=[1])
+        pages.set_parsed([self.document.pages[0]])
+        partial = self.document.model_copy(update={ 'pages': pages })
+        data = partial.to_bytes()
+        self.assertTrue(is_partially_parsed_document(data))
+        self.assertEqual(cast(LazyPages, Document.from_bytes(data).pages).unparsed, {1})
+
+
+class TestEvaluateRegions(unittest.IsolatedAsyncioTestCase):
+
+    class Parser(DocumentParser):
+        def __init__(self, failing_pages: Iterable[int] = ()):
+            super().__init__(paperless.PaperlessDocument.model_construct(id=1, title='Test'), None)
+            self.failing_pages = set(failing_pages)
+            self.calls: list[list[int]] = []
+
+        @property
+        def parsed(self) -> list[int]:
+            return [n for call in self.calls for n in call]
+
+        async def parse_pages(self, page_nrs: list[int]) -> tuple[list[Page], str | None]:
+            self.calls.append(page_nrs)
+            runs = [[TextRun.model_validate({ 'text': f'Page {n + 1}', 'x': 10, 'y': 10, 'x2': 50, 'y2': 20 })] for n in page_nrs]
+            pages = [Page(page_nr=n, width=100, height=100, text_runs=TextRuns.from_runs(r)) for n, r in zip(page_nrs, runs)]
+            if failed := self.failing_pages & set(page_nrs):
+                return [p for p in pages if p.page_nr < min(failed)], 'error'
+            return pages, None
+
+    @staticmethod
+    def document(parser: DocumentParser, num_pages: int) -> Document:
+        now = datetime.datetime(2024, 1, 1, 12, 0).astimezone()
+        doc = Document.model_validate({ 'id': 1, 'title': 'Test', 'correspondent': None, 'document_type': None, 'paperless_url': 'http://localhost/documents/1/details',
+                                        'datetime_added': now, 'date_created': now.date(), 'pages': [], 'parse_status': DocumentParseStatus(datetime_parsed=now, error=None) })
+        doc.pages = LazyPages(num_pages, None, unparsed=range(num_pages))
+        doc.attach_parser(parser)
+        return doc
+
+    def test_page_regions_match_single_regions(self):
+        runs = [TextRun.model_validate({ 'text': f'w{i}', 'x': (i * 37) % 500, 'y': (i * 13) % 800, 'x2': (i * 37) % 500 + 20, 'y2': (i * 13) % 800 + 9 }) for i in range(400)]
+        page = Page(page_nr=0, width=600, height=900, text_runs=TextRuns.from_runs(runs))
+        regions = [Region.model_validate({ 'x': x, 'y': y, 'x2': x2, 'y2': y2, 'kind': 'regex', 'regex_expr': '(?P<first>w\\d+)' })
+                   for x, y, x2, y2 in [(-10, -10, 600, 900), (100, 100, 220, 150), (37, 13, 57, 22), (300, 900, 400, 950)]]
+        self.assertEqual(page.evaluate_regions(regions), [page.evaluate_region(r) for r in regions])
+
+    async def test_negative_page_with_stop_early(self):
+        region = Region.model_validate({ 'x': 0, 'y': 0, 'x2': 100, 'y2': 100, 'kind': 'simple', 'simple_expr': 'Page <n:number>', 'page': -1 })
+        for failing_pages, expected_value, expected_parsed in [((), '3', [2]), ((2,), '2', [2, 0, 1])]:
+            parser = self.Parser(failing_pages)
+            doc = self.document(parser, 3)
+
+            results = await doc.evaluate_regions([region], stop_early=True)
+            selected = region.get_selected_result(results[0])
+            assert selected is not None
+            self.assertEqual(selected.group_values, { 'n': expected_value })
+            self.assertEqual(parser.parsed, expected_parsed)
+
+    async def test_iter_pages_parses_batches(self):
+        parser = self.Parser()
+        doc = self.document(parser, 20)
+        self.assertEqual([page.page_nr async for page in doc.iter_pages(reverse=True)], list(reversed(range(20))))
+        self.assertEqual(parser.calls, [list(range(12, 20)), list(range(4, 12)), list(range(0, 4))])
+
+    async def test_document_is_truncated_at_first_failing_page(self):
+        for requested in [[5, 4], [2], [3]]:
+            doc = self.document(self.Parser(failing_pages=(2, 4)), 6)
+            for page_nr in requested:
+                await doc.load_pages([page_nr])
+            self.assertEqual([page.page_nr async for page in doc.iter_pages()], [0, 1])
+            self.assertEqual(len(doc.pages), 2)
+            self.assertEqual(doc.parse_status.error, 'error')
+
+
+class TestTextRunIndex(unittest.TestCase):
+
+    def test_find_enclosed_matches_brute_force(self):
+        runs = [TextRun.model_validate({ 'text': str(i), 'x': (i * 37) % 500, 'y': (i * 13) % 800, 'x2': (i * 37) % 500 + 20, 'y2': (i * 13) % 800 + 9 }) for i in range(400)]
+        index = TextRunIndex(TextRuns.from_runs(runs))
+        for x, y, x2, y2 in [(-10, -10, 600, 900), (100, 100, 220, 150), (37, 13, 57, 22), (300, 900, 400, 950)]:
+            region = RegionBase.model_validate({ 'x': x, 'y': y, 'x2': x2, 'y2': y2 })
+            expected = [i for i, r in enumerate(runs) if r.x > region.x and r.x2 <= region.x2 and r.y > region.y and r.y2 <= region.y2]
+            self.assertEqual(index.find_enclosed(region), expected)
+
+
+class TestRegionExpressions(unittest.TestCase):
+
+    def test_matcher_is_compiled_once(self):
+        region = Region.model_validate({ 'x': 0, 'y': 0, 'x2': 100, 'y2': 100, 'kind': 'simple', 'simple_expr': 'Total <amount:number>' })
+        other = region.model_copy()
+        compile_expression.cache_clear()
+        self.assertEqual(region.evaluate_on_text(0, 'total 12.50').group_values, {'amount': '12.50'})
+        self.assertIsNone(other.evaluate_on_text(0, 'nothing').group_values)
+        self.assertEqual(compile_expression.cache_info().misses, 1)
+
+    def test_invalid_expressions(self):
+        def region(**expression: str) -> Region:
+            return Region.model_validate({ 'x': 0, 'y': 0, 'x2': 1, 'y2': 1, **expression })
+
+        self.assertIsNotNone(region(kind='simple', simple_expr='<amount>').evaluate_on_text(0, '').error)
+        self.assertEqual(region(kind='regex', regex_expr='(').evaluate_on_text(0, '').error, 'missing ), unterminated subpattern')
+
+
+class TestFieldRender(unittest.TestCase):
+
+    def test_render_fields(self):
+        fields = [Field(name='amount', template='{{ amount | parse_monetary }}'), Field(name='date', template='{{ date | parse_date }}'), Field(name='broken', template='{{ amount')]
+        compile_template.cache_clear()
+        for _ in range(2):
+            results = render_fields(fields, {'amount': '1.234,50', 'date': '24/12/2023'})
+            self.assertEqual([r.value for r in results], ['1234.50', '2023-12-24', None])
+            self.assertIsNotNone(results[2].error)
+        self.assertEqual(compile_template.cache_info().hits, 2)
+
+    def test_parse_date_rejects_other_types(self):
+        for value in (['24/12/2023'], 24122023):
+            with self.assertRaises(ValueError):
+                utils.parse_date(cast(str, value))
+
+
+class TestContentAddressedCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = cache.ContentAddressedCache(diskcache.Cache(self.tmpdir.name, eviction_policy='none'), size_limit=10_000_000)
+
+    def tearDown(self) -> None:
+        self.cache.cache.close()
+        self.tmpdir.cleanup()
+
+    def count_values(self) -> int:
+        return len([k for k in self.cache.cache.iterkeys() if isinstance(k, str) and k.startswith('value:')])
+
+    def test_shared_values_are_stored_once(self):
+        value = b'x' * 100_000
+        self.cache.set('a', value)
+        self.cache.set('b', value)
+        self.assertEqual(self.cache.get('a'), value)
+        self.assertEqual(self.count_values(), 1)
+
+        self.cache.set('a', b'other')
+        self.assertEqual(self.cache.get('b'), value)
+        self.cache.set('b', b'other')
+        self.assertEqual(self.count_values(), 1)
+
+    def test_cull_keeps_values_with_aliases(self):
+        self.cache.set('old', b'1' * 1_000_000)
+        self.cache.set('shared-1', b'2' * 1_000_000)
+        self.cache.size_limit = 2_000_000
+        self.cache.set('shared-2', b'2' * 1_000_000)
+        self.cache.set('new', b'3' * 1_000_000)
+        self.assertIsNone(self.cache.get('old'))
+        self.assertIsNotNone(self.cache.get('new'))
+
+
+class TestDocumentIndex(unittest.IsolatedAsyncioTestCase):
+
+    class Client(paperless.PaperlessClient):
+        def __init__(self):
+            super().__init__()
+            self.urls: list[str] = []
+            self.documents: list[paperless.PaperlessDocumentModificationDatetime] = []
+
+        async def iter_paginated_results(self, url: str, result_type: type[paperless.PaperlessDataT]) -> AsyncGenerator[paperless.PaperlessDataT, None]:
+            self.urls.append(url)
+            for doc in self.documents:
+                yield cast(paperless.PaperlessDataT, doc)
+
+        async def get_document_metadata(self, document_id: int) -> paperless.PaperlessDocumentMetadata:
+            self.urls.append(f'metadata/{document_id}')
+            return paperless.PaperlessDocumentMetadata(original_checksum=f'checksum-{document_id}')
+
+    async def test_checksums_are_retrieved_once_per_modification(self):
+        t1 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        t2 = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+        client = self.Client()
+        client.documents = [paperless.PaperlessDocumentModificationDatetime(id=i, modified=t1) for i in range(3)]
+        index = paperless.DocumentIndex()
+
+        self.assertEqual(await index.get_checksum(client, 1), 'checksum-1')
+        self.assertEqual(await index.get_checksum(client, 1), 'checksum-1')
+        self.assertEqual(await index.get_checksum(client, 2), 'checksum-2')
+        self.assertEqual(len(client.urls), 3) # listing and two metadata requests
+
+        index.last_refresh = None
+        client.documents = [paperless.PaperlessDocumentModificationDatetime(id=1, modified=t2)]
+        await index.get_checksum(client, 1)
+        self.assertIn('modified__gt=', client.urls[3])
+        self.assertEqual(client.urls[4], 'metadata/1')
+
+    async def test_updates_dont_skip_other_modifications(self):
+        t0 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        t2 = datetime.datetime(2024, 1, 3, tzinfo=datetime.timezone.utc)
+        client = self.Client()
+        client.documents = [paperless.PaperlessDocumentModificationDatetime(id=i, modified=t0) for i in range(3)]
+        index = paperless.DocumentIndex()
+        await index.refresh(client)
+
+        index.update(2, t2) # eg. saved by processing, after document 1 was modified in paperless
+        index.last_refresh = None
+        await index.refresh(client)
+        self.assertIn(f'modified__gt={urllib.parse.quote(t0.isoformat())}', client.urls[1])
+
+
+class TestBlobStore(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = cache.BlobStore(pathlib.Path(self.tmpdir.name), size_limit=2_500)
+        self.fetched: list[str] = []
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def fetch(self, key: str):
+        async def fetch():
+            self.fetched.append(key)
+            yield b'x' * 1000
+        return fetch
+
+    async def test_fetches_once_and_evicts_unused(self):
+        async with self.store.open('a', self.fetch('a')) as path_a:
+            self.assertEqual(path_a.read_bytes(), b'x' * 1000)
+            await self.store.acquire('a', self.fetch('a'))
+            self.store.release('a')
+            for key in ('b', 'c', 'd'):
+                async with self.store.open(key, self.fetch(key)):
+                    pass
+            self.assertTrue(path_a.exists()) # in use
+
+        self.assertEqual(self.fetched, ['a', 'b', 'c', 'd'])
+        self.assertFalse(self.store.get_path('b').exists())
+        self.assertTrue(self.store.get_path('d').exists())
+
+    async def test_missing_file_is_fetched_again(self):
+        async with self.store.open('a', self.fetch('a')):
+            pass
+        self.store.get_path('a').unlink() # eg. removed by a concurrent cull
+        async with self.store.open('a', self.fetch('a')) as path:
+            self.assertTrue(path.exists())
+        self.assertEqual(self.fetched, ['a', 'a'])
+
+
+class TestAdaptiveLimiter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_window_adapts_and_limits_concurrency(self):
+        limiter = paperless.AdaptiveLimiter('test', 4)
+        limiter.on_overload()
+        limiter.on_overload() # ignored, too soon after the first
+        self.assertEqual(limiter.window, 2)
+        for _ in range(2):
+            limiter.on_success()
+        self.assertEqual(limiter.window, 3)
+
+        running = 0
+        max_running = 0
+        async def task():
+            nonlocal running, max_running
+            async with limiter.slot():
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+        await asyncio.gather(*(task() for _ in range(10)))
+        self.assertEqual(max_running, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_retries_overloaded_requests(self):
+        statuses = [503, 500, 200, 500, 500, 500, 500, 500]
+        async def handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+            return aiohttp.web.Response(status=statuses.pop(0), text='{"original_checksum": "abc"}', content_type='application/json', headers={'Retry-After': '0'})
+        app = aiohttp.web.Application()
+        app.router.add_get('/api/documents/1/metadata/', handler)
+
+        async with aiohttp.test_utils.TestServer(app) as server:
+            client = paperless.PaperlessClient(base_url=str(server.make_url('')))
+            self.assertEqual((await client.get_document_metadata(1)).checksum, 'abc')
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await client.get_document_metadata(1)
+        self.assertEqual(statuses, [])
+
+
+class TestPipelineStage(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stages_process_all_items_with_bounded_concurrency(self):
+        inputs: asyncio.Queue[int | None] = asyncio.Queue(2)
+        outputs: asyncio.Queue[int | None] = asyncio.Queue(2)
+        running = 0
+        max_running = 0
+
+        async def double(item: int) -> int | None:
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.001 * (item % 3))
+            running -= 1
+            return item * 2 if item % 5 else None
+
+        async def produce():
+            for i in range(20):
+                await inputs.put(i)
+            await inputs.put(None)
+
+        results: list[int] = []
+        async def consume(item: int) -> None:
+            results.append(item)
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(produce())
+            tg.create_task(matching.run_pipeline_stage(inputs, outputs, double, 3))
+            tg.create_task(matching.run_pipeline_stage(outputs, None, consume, 1))
+
+        self.assertEqual(sorted(results), [i * 2 for i in range(20) if i % 5])
+        self.assertEqual(max_running, 3)
+
+
+class TestLedger(unittest.TestCase):
+
+    def test_unchanged_patterns(self):
+        t1 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        t2 = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+        paperless_doc = paperless.PaperlessDocument.model_construct(id=1, modified=t1)
+        l = ledger.Ledger()
+        l.record(1, t1, { 'a': ledger.PatternRecord(fingerprint='fa', matched=True), 'b': ledger.PatternRecord(fingerprint='fb', matched=False) })
+        l = ledger.Ledger.model_validate_json(l.model_dump_json())
+
+        self.assertEqual(set(l.get_unchanged_patterns(paperless_doc, { 'a': 'fa', 'b': 'fb2', 'c': 'fc' })), { 'a' })
+        self.assertEqual(l.get_unchanged_patterns(paperless_doc.model_copy(update={ 'modified': t2 }), { 'a': 'fa' }), {})
+
+
+class TestCheckMetadata(unittest.IsolatedAsyncioTestCase):
+
+    async def test_checks_are_decided_on_metadata_where_possible(self):
+        client = TestPatternIndex.Client()
+        region_check = { 'type': 'region', 'x': 0, 'y': 0, 'x2': 100, 'y2': 100, 'page': 0, 'kind': 'simple', 'simple_expr': 'Page <n:number>' }
+        def pattern(*checks: dict[str, Any]) -> Pattern:
+            return Pattern.model_validate({ 'name': 'test', 'checks': checks, 'regions': [], 'fields': [] })
+
+        invoice = paperless.PaperlessDocument.model_construct(title='Invoice 123', page_count=2, correspondent=1, tags=[1])
+        receipt = paperless.PaperlessDocument.model_construct(title='Receipt', page_count=None, correspondent=None, tags=[])
+
+        self.assertIs(await pattern({ 'type': 'title', 'regex': 'Invoice' }, region_check).match_metadata(receipt, client), False)
+        self.assertIsNone(await pattern({ 'type': 'title', 'regex': 'Invoice' }, region_check).match_metadata(invoice, client))
+        self.assertIs(await pattern({ 'type': 'or', 'checks': [region_check, { 'type': 'title', 'regex': 'Invoice' }] }).match_metadata(invoice, client), True)
+        self.assertIs(await pattern({ 'type': 'not', 'check': { 'type': 'title', 'regex': 'Invoice' } }).match_metadata(invoice, client), False)
+        self.assertIs(await pattern({ 'type': 'num_pages', 'num_pages': 1 }).match_metadata(invoice, client), False)
+        self.assertIsNone(await pattern({ 'type': 'num_pages', 'num_pages': 1 }).match_metadata(receipt, client))
+        self.assertFalse(pattern({ 'type': 'and', 'checks': [{ 'type': 'title', 'regex': 'Invoice' }] }).checks[0].needs_document())
+
+        acme_inbox = pattern({ 'type': 'or', 'checks': [region_check, { 'type': 'and', 'checks': [{ 'type': 'tags', 'includes': ['inbox'] }, { 'type': 'correspondent', 'name': 'ACME' }] }] })
+        self.assertIs(await acme_inbox.match_metadata(invoice, client), True)
+        self.assertIsNone(await acme_inbox.match_metadata(receipt, client))
+        self.assertIs(await pattern({ 'type': 'correspondent', 'name': '' }).match_metadata(receipt, client), True)
+        self.assertIs(await pattern({ 'type': 'tags', 'excludes': ['inbox'] }).match_metadata(invoice, client), False)
+        self.assertIsNone(await pattern({ 'type': 'title', 'regex': '(' }).match_metadata(invoice, client)) # error left to get_check_results()
+
+        # Region checks are only decided on the document
+        doc = TestEvaluateRegions.document(TestEvaluateRegions.Parser(), 2)
+        self.assertIsNone(await pattern(region_check).match_metadata(invoice, client))
+        self.assertIs(await pattern(region_check).checks_match(doc, invoice, client), True)
+        self.assertIs(await pattern({ **region_check, 'simple_expr': 'Total <n:number>' }).checks_match(doc, invoice, client), False)
+
+    async def test_check_contexts_are_collected_with_their_clients(self):
+        client = TestPatternIndex.Client()
+        context = weakref.ref(await get_check_context(client, []))
+        del client
+        gc.collect()
+        self.assertIsNone(context())
+
+
+class TestPatternIndex(unittest.IsolatedAsyncioTestCase):
+
+    class Client(paperless.PaperlessClient):
+        @asyncstdlib.cached_property
+        async def correspondents_by_id(self) -> Mapping[int, paperless.PaperlessCorrespondent]:  # pyright: ignore[reportIncompatibleVariableOverride]
+            return { 1: paperless.PaperlessCorrespondent.model_construct(id=1, name='ACME'), 2: paperless.PaperlessCorrespondent.model_construct(id=2, name='Other') }
+
+        @asyncstdlib.cached_property
+        async def document_types_by_id(self) -> Mapping[int, paperless.PaperlessDocumentType]:  # pyright: ignore[reportIncompatibleVariableOverride]
+            return { 1: paperless.PaperlessDocumentType.model_construct(id=1, name='Invoice') }
+
+        @asyncstdlib.cached_property
+        async def storage_paths_by_id(self) -> Mapping[int, paperless.PaperlessStoragePath]:  # pyright: ignore[reportIncompatibleVariableOverride]
+            return {}
+
+        @asyncstdlib.cached_property
+        async def tags_by_id(self) -> Mapping[int, paperless.PaperlessTag]:  # pyright: ignore[reportIncompatibleVariableOverride]
+            return { 1: paperless.PaperlessTag.model_construct(id=1, name='inbox') }
+
+    async def test_candidates(self):
+        def pattern(name: str, *checks: dict[str, Any], enabled: bool = True) -> Pattern:
+            return Pattern.model_validate({ 'name': name, 'enabled': enabled, 'checks': checks, 'regions': [], 'fields': [] })
+
+        index = PatternIndex([
+            pattern('acme', { 'type': 'and', 'checks': [{ 'type': 'correspondent', 'name': 'ACME' }] }),
+            pattern('invoice', { 'type': 'document_type', 'name': 'Invoice' }, { 'type': 'title', 'regex': 'x' }),
+            pattern('inbox', { 'type': 'tags', 'includes': ['inbox'] }),
+            pattern('any', { 'type': 'or', 'checks': [{ 'type': 'correspondent', 'name': 'ACME' }, { 'type': 'title', 'regex': 'x' }] }),
+            pattern('disabled', enabled=False),
+        ])
+        client = self.Client()
+        acme = paperless.PaperlessDocument.model_construct(correspondent=1, document_type=None, storage_path=None, tags=[1])
+        other = paperless.PaperlessDocument.model_construct(correspondent=2, document_type=1, storage_path=None, tags=[])
+
+        self.assertEqual([p.name for p in await index.get_candidates(acme, client)], ['acme', 'inbox', 'any'])
+        self.assertEqual([p.name for p in await index.get_candidates(other, client)], ['invoice', 'any'])
+
+
+
+class TestDocumentQuery(unittest.IsolatedAsyncioTestCase):
+
+    def pattern(self, *checks: dict[str, Any]) -> Pattern:
+        return Pattern.model_validate({ 'name': 'test', 'checks': checks, 'regions': [], 'fields': [] })
+
+    async def test_query(self):
+        client = TestPatternIndex.Client()
+        title = { 'type': 'title', 'regex': r'Invoice\.? (\d+)' }
+        pattern = self.pattern(
+            { 'type': 'and', 'checks': [{ 'type': 'correspondent', 'name': 'ACME' }, { 'type': 'tags', 'includes': ['inbox'] }] },
+            { 'type': 'or', 'checks': [{ 'type': 'correspondent', 'name': 'ACME' }, { 'type': 'correspondent', 'name': 'Other' }] },
+            { 'type': 'not', 'check': { 'type': 'document_type', 'name': 'Invoice' } },
+            { 'type': 'date_created', 'after': '2024-01-01' },
+            title,
+        )
+        query = await pattern.get_document_query(client)
+        assert query is not None
+        params, residual_checks = query
+        self.assertEqual(params, {
+            'correspondent__id__in': '1',
+            'tags__id__all': '1',
+            'document_type__id__none': '1',
+            'created__date__gt': '2024-01-01',
+            'title__istartswith': 'Invoice',
+        })
+        self.assertEqual([c.model_dump(exclude_defaults=True) for c in residual_checks], [title])
+
+    async def test_no_match(self):
+        client = TestPatternIndex.Client()
+        self.assertIsNone(await self.pattern({ 'type': 'correspondent', 'name': 'Unknown' }).get_document_query(client))
+
+        # Not expressible, evaluated locally
+        storage_path = { 'type': 'storage_path', 'name': '' }
+        or_check = { 'type': 'or', 'checks': [{ 'type': 'correspondent', 'name': 'ACME' }, { 'type': 'title', 'regex': 'x' }] }
+        query = await self.pattern(storage_path, or_check).get_document_query(client)
+        assert query is not None
+        self.assertEqual(query[0], { 'storage_path__isnull': '1' })
+        self.assertEqual(len(query[1]), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
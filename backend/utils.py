@@ -1,33 +1,78 @@
 import calendar
+import functools
+import re
 from dateutil import parser
 from datetime import date
 
 
 PARSE_DATE_LOCALES = ['fr_FR', 'de_DE', 'en_US']
 
+# Numeric dates handled without dateutil, with the same interpretation as dateutil (month first unless that is impossible)
+YEAR_FIRST_DATE_RE = re.compile(r'(\d{4})([-/.])(\d{1,2})\2(\d{1,2})')
+YEAR_LAST_DATE_RE = re.compile(r'(\d{1,2})([-/.])(\d{1,2})\2(\d{4})')
+
+
+@functools.cache
+def get_locale_parser_info(loc_name: str) -> parser.parserinfo | None:
+    # Built once per locale, None if the locale is not available
+    if '.' not in loc_name:
+        loc_name += '.UTF-8'
+    try:
+        cal = calendar.LocaleTextCalendar(locale=loc_name) # type: ignore
+
+        short_weekday_names = cal.formatweekheader(2).split()
+        long_weekday_names = cal.formatweekheader(20).split()
+        short_month_names = [cal.formatmonthname(3, i, width=20, withyear=False).strip() for i in range(1, 13)]
+        long_month_names = [cal.formatmonthname(20, i, width=20, withyear=False).strip() for i in range(1, 13)]
+
+        class LocaleParserInfo(parser.parserinfo):
+            MONTHS = list(zip(short_month_names, long_month_names))
+            WEEKDAYS = list(zip(short_weekday_names, long_weekday_names))
+
+        return LocaleParserInfo()
+    except Exception:
+        return None
+
+
+def parse_numeric_date(date_string: str) -> date | None:
+    try:
+        if match := YEAR_FIRST_DATE_RE.fullmatch(date_string):
+            return date(int(match[1]), int(match[3]), int(match[4]))
+
+        if match := YEAR_LAST_DATE_RE.fullmatch(date_string):
+            first, second, year = int(match[1]), int(match[3]), int(match[4])
+            if first > 12:
+                return date(year, second, first)
+            return date(year, first, second)
+    except ValueError:
+        pass # eg. day out of range, leave it to dateutil
+    return None
+
+
+def parse_date(date_string: str) -> date:
+    if not isinstance(date_string, str): # pyright: ignore[reportUnnecessaryIsInstance]
+        # eg. a list from a malformed pattern, fails like a string that can't be parsed rather than in the memoization
+        raise ValueError(f"Could not parse '{date_string}' with any of the supported locales: {PARSE_DATE_LOCALES}")
+    return parse_date_string(date_string)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_date_string(date_string: str) -> date:
+    # Memoized, as the same dates tend to be parsed repeatedly (eg. for every field of a document)
+    if (parsed_date := parse_numeric_date(date_string.strip())) is not None:
+        return parsed_date
 
-def parse_date(date_string: str) -> date:    
     for loc_name in PARSE_DATE_LOCALES:
-        if '.' not in loc_name:
-            loc_name += '.UTF-8'
+        parser_info = get_locale_parser_info(loc_name)
+        if parser_info is None:
+            continue # Try the next locale
         try:
-            cal = calendar.LocaleTextCalendar(locale=loc_name) # type: ignore
-            
-            short_weekday_names = cal.formatweekheader(2).split()
-            long_weekday_names = cal.formatweekheader(20).split()
-            short_month_names = [cal.formatmonthname(3, i, width=20, withyear=False).strip() for i in range(1, 13)]
-            long_month_names = [cal.formatmonthname(20, i, width=20, withyear=False).strip() for i in range(1, 13)]
-            
-            class LocaleParserInfo(parser.parserinfo):
-                MONTHS = list(zip(short_month_names, long_month_names))
-                WEEKDAYS = list(zip(short_weekday_names, long_weekday_names))
-    
-            parsed_dt = parser.parse(date_string, parserinfo=LocaleParserInfo())
-            
+            parsed_dt = parser.parse(date_string, parserinfo=parser_info)
+
             return parsed_dt.date()
 
         except Exception:
             continue # Try the next locale
-            
+
     # If the loop finishes without returning, parsing failed for all locales
     raise ValueError(f"Could not parse '{date_string}' with any of the supported locales: {PARSE_DATE_LOCALES}")